@@ -173,3 +173,9 @@ BINARIZATION_SERIVICE_BASE_URL = "http://binarizationservice.acis.ufl.edu"
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a trailing slash.
 MEDIA_URL = '/data/'
+# Number of worker processes binarizing the images of batch requests (0: one per CPU).
+# The workers are started by the first batch request and kept for the later ones.
+BATCH_WORKERS = 0
+# Bytes of flattened pages kept in memory (per process) for re-binarizing a page with only
+# threshold, lo, hi or escale changed (0: no cache).
+FLAT_CACHE_BYTES = 256*1024*1024
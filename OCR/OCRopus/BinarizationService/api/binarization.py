@@ -23,11 +23,14 @@
 from __future__ import print_function
 from pylab import *
 from numpy.ctypeslib import ndpointer
-import os, os.path
+import os, os.path, math, tempfile, hashlib, threading
+from collections import OrderedDict
 from scipy.ndimage import filters, interpolation, morphology, measurements
 from scipy import stats
 import ocrolib
 import StringIO, PIL, numpy
+from django.core.files.base import ContentFile
+from django.conf import settings
 from numpy import amax, amin
 import logging
 
@@ -39,6 +42,19 @@ args_default = {
 
 # The global variable
 args = {}
+class RequestTimer(threading.local):
+    """The ocrolib.StageTimer of the request served by the current thread,
+    so that concurrent requests of a threaded server time their own
+    stages.  start() begins the timer of a new request."""
+    def __init__(self):
+        self.start()
+    def start(self):
+        self.current = ocrolib.StageTimer()
+    def __getattr__(self,name):
+        return getattr(self.current,name)
+
+# Timing of the stages of the current request (see ocrolib.StageTimer)
+timer = RequestTimer()
 logger = logging.getLogger('django')
 
 # The entry of binarization service
@@ -47,6 +63,7 @@ def binarization_exec(image, parameters):
     # Each time update the args with the default args dictionary, avoid the effect of the previous update
     global args
     args = args_default.copy()
+    timer.start()
     args.update(parameters)
     print("=====Parameters Values =====")
     print(args)
@@ -66,7 +83,48 @@ def binarization_exec(image, parameters):
         output_file = None
 
     return output_file
-    
+
+
+def binarization_sweep(image, parameters, thresholds, percentiles):
+    """Entry of the sweep service: like binarization_exec(), but returns
+    the list of ((lo,hi,threshold),image) of process_sweep(), or None."""
+    global args
+    args = args_default.copy()
+    timer.start()
+    args.update(parameters)
+
+    if len(image) < 1:
+        print("ERROR: Please upload an image")
+        return None
+
+    try:
+        outputs = process_sweep(image, thresholds, percentiles)
+    except:
+        outputs = None
+
+    return outputs
+
+
+def binarization_job(job):
+    """Binarize one page of a batch request inside a pool worker. The job is
+    (index, name, image data or (path, pageno) of a multi-page image,
+    parameters); the result is (index, name, data encoded as
+    args['output_format'], stage timings), with None as data if the
+    binarization failed."""
+    index, name, data, parameters = job
+    if type(data)!=tuple:
+        data = ContentFile(data, name=name)
+    output_file = binarization_exec(data, parameters)
+    if output_file is None:
+        return index, name, None, timer.spans
+    output = StringIO.StringIO()
+    save_output(output_file, output)
+    return index, name, output.getvalue(), timer.spans
+
+
+def ftype():
+    """The floating point type of the pipeline for args['precision']."""
+    return 'f' if args['precision']=='float32' else 'd'
 
 def print_info(*objs):
     print("INFO: ", *objs, file=sys.stdout)
@@ -93,6 +151,104 @@ def estimate_skew_angle(image,angles):
     _,a = max(estimates)
     return a
 
+def decimate(image,f):
+    """Shrink the image by an integer factor by averaging f x f blocks."""
+    if f<=1: return image
+    h,w = image.shape[0]//f,image.shape[1]//f
+    return image[:h*f,:w*f].reshape(h,f,w,f).mean(axis=3).mean(axis=1)
+
+def sheared_profile(csum,a,row0=0,length=0):
+    """Row projection profile of the image rotated by `a` degrees, computed
+    by shearing the row index of every column instead of resampling the
+    image.  `csum` holds the cumulative column sums of the image with a
+    leading zero column, so each run of columns sharing the same shift is
+    summed with a single subtraction.  `row0` and `length` place the rows
+    of a horizontal strip within the profile of the whole page."""
+    h,w = csum.shape[0],csum.shape[1]-1
+    t = tan(radians(a))
+    shifts = array(rint(-arange(w)*t),'i')
+    edges = flatnonzero(diff(shifts))+1
+    starts,stops = r_[0,edges],r_[edges,w]
+    runs = csum[:,stops]-csum[:,starts]
+    rows = row0+arange(h)[:,newaxis]+(shifts[starts]-amin(shifts))[newaxis,:]
+    return bincount(rows.ravel(),weights=runs.ravel(),minlength=length)
+
+def profile_variance(profile,h,w,a):
+    """Variance of a sheared profile of an h x w image, scaled like the
+    profile of `interpolation.rotate(image,a)`, which is padded with empty
+    rows and has wider rows, so that it can be compared across angles."""
+    c,s = abs(cos(radians(a))),abs(sin(radians(a)))
+    rh,rw = h*c+w*s,w*c+h*s
+    v = sum(profile**2)/rh-(sum(profile)/rh)**2
+    return v/rw**2
+
+def sheared_profile_variance(csum,a):
+    """Variance of the row projection profile of the image rotated by `a`
+    degrees (see sheared_profile() and profile_variance())."""
+    h,w = csum.shape[0],csum.shape[1]-1
+    return profile_variance(sheared_profile(csum,a),h,w,a)
+
+def estimate_skew_angle_sheared(image,angles,coarse=1024):
+    """Coarse-to-fine replacement for estimate_skew_angle().  Every
+    sqrt(n)-th candidate angle is first scored on a copy of the page
+    decimated to about `coarse` pixels; the candidates around the best
+    one are then scored on the full page.  Returns one of the given angles."""
+    angles = sorted(angles)
+    n = len(angles)
+    stride = max(1,int(sqrt(n)))
+    small = decimate(image,max(1,max(image.shape)//coarse))
+    csum = c_[zeros(small.shape[0]),cumsum(small,axis=1,dtype='d')]
+    estimates = [(sheared_profile_variance(csum,angles[i]),i) for i in range(0,n,stride)]
+    _,best = max(estimates)
+    csum = c_[zeros(image.shape[0]),cumsum(image,axis=1,dtype='d')]
+    candidates = range(max(0,best-stride+1),min(n,best+stride))
+    estimates = [(sheared_profile_variance(csum,angles[i]),angles[i]) for i in candidates]
+    _,a = max(estimates)
+    return a
+
+def percentile_filter_hist(image,percentile,size,bins=256):
+    """Quantized replacement for filters.percentile_filter() on 2D images.
+    The image is quantized into `bins` levels and a histogram per output
+    column is updated incrementally as the window slides down the rows
+    (images whose window is wider than tall are transposed first).  The
+    percentile is located with a two-level (coarse/fine) histogram search.
+    Borders are reflected like scipy's default mode, and the result differs
+    from scipy's by at most half a quantization step, (max-min)/(2*(bins-1))."""
+    a,b = size
+    if a<b: return percentile_filter_hist(image.T,percentile,(b,a),bins=bins).T
+    h,w = image.shape
+    lo,hi = amin(image),amax(image)
+    if hi==lo: return image.copy()
+    step = (hi-lo)/(bins-1.0)
+    q = array(rint((image-lo)/step),'i')
+    # numpy's 'symmetric' padding is scipy.ndimage's 'reflect' mode
+    q = pad(q,((a//2,a-a//2-1),(b//2,b-b//2-1)),mode='symmetric')
+    rank = int(a*b*percentile/100.0)
+    if rank==a*b: rank -= 1
+    # per column histograms, flattened so that updates are 1D fancy indexing
+    nc = int(ceil(bins**0.5))
+    qc = q//nc
+    fine = zeros(w*nc*nc,'i')
+    coarse = zeros(w*nc,'i')
+    fo,co = arange(w)*nc*nc,arange(w)*nc
+    def update(row,d):
+        for j in range(b):
+            fine[fo+q[row,j:j+w]] += d
+            coarse[co+qc[row,j:j+w]] += d
+    for y in range(a): update(y,1)
+    fine2,coarse2 = fine.reshape(w*nc,nc),coarse.reshape(w,nc)
+    result = zeros((h,w),'i')
+    for y in range(h):
+        cc = cumsum(coarse2,axis=1)
+        cb = sum(cc<=rank,axis=1)
+        below = cc.ravel()[co+cb]-coarse[co+cb]
+        fc = cumsum(fine2[co+cb],axis=1)
+        result[y] = cb*nc+sum(fc<=(rank-below)[:,newaxis],axis=1)
+        if y+1<h:
+            update(y,-1)
+            update(y+a,1)
+    return array(lo+step*result,image.dtype)
+
 def H(s): return s[0].stop-s[0].start
 def W(s): return s[1].stop-s[1].start
 def A(s): return W(s)*H(s)
@@ -111,38 +267,168 @@ def array2pil(a):
     else:
         raise Exception("unknown image type")
 
+# content type and file extension of each args['output_format']
+output_formats = {
+'png':('image/png','png'),
+'png1':('image/png','png'),
+'tiffg4':('image/tiff','tif'),
+'packbits':('application/octet-stream','bin'),
+}
 
-def process(imagepath):
-    logger.info("# %s" % (imagepath))
-    raw = ocrolib.read_image_gray(imagepath) 
+def save_output(image_pil,stream):
+    """Encode the binarized image returned by process() into the stream,
+    with the encoding of args['output_format'].  The bilevel encodings are
+    built from the packed bits of the page, not from the 8-bit image."""
+    with timer.span("encode"):
+        encode_output(image_pil,stream)
 
-    # perform image normalization
-    image = raw-amin(raw)
-    if amax(image)==amin(image):
-        logger.info("# image is empty: %s" % (imagepath))
+def encode_output(image_pil,stream):
+    if args['output_format']=='png':
+        image_pil.save(stream,"PNG")
         return
-    image /= amax(image)
+    binary = ocrolib.pil2array(image_pil)>127
+    if args['output_format']=='packbits':
+        stream.write(ocrolib.pack_binary(binary))
+    elif args['output_format']=='png1':
+        ocrolib.binary2pil(binary).save(stream,"PNG",optimize=False)
+    elif args['output_format']=='tiffg4':
+        ocrolib.binary2pil(binary).save(stream,"TIFF",compression="group4")
+    else:
+        raise Exception("unknown output format "+args['output_format'])
+
+
+################################################################
+### Cache of flattened pages.
+###
+### Re-submitting a page with only `threshold`, `lo`, `hi` or `escale`
+### changed reuses the flattened and deskewed page of the previous
+### request, found by the digest of the image and the parameters that
+### affect flattening and deskewing.
+################################################################
+
+# parameters that change the flattened and deskewed page
+flat_parameters = ['zoom','perc','range','maxskew','skewsteps','bignore',
+                   'flatmethod','skewmethod','precision','decode']
+
+class FlatCache:
+    """Least recently used cache of flattened pages, limited by the number
+    of bytes of the arrays it holds.  An entry is a dictionary holding the
+    `flat` page, its skew `angle`, and the threshold estimation `masks`
+    of the page for each `escale` and `maskmethod` (see mask_key()).
+    Entries are shared by the request threads, so they are never modified
+    once cached: add_mask() replaces them."""
+    def __init__(self,maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        # bytes of each entry when it was inserted
+        self.sizes = {}
+        self.nbytes = 0
+        self.lock = threading.Lock()
+    def size(self,entry):
+        return entry['flat'].nbytes+sum(v.nbytes for v in entry['masks'].values() if v is not None)
+    def get(self,key):
+        with self.lock:
+            entry = self.entries.pop(key,None)
+            if entry is not None: self.entries[key] = entry
+            return entry
+    def put(self,key,entry):
+        """Insert or update an entry, evicting the least recently used
+        entries beyond maxbytes.  Entries larger than maxbytes are dropped."""
+        with self.lock:
+            self.insert(key,entry)
+    def add_mask(self,key,entry,mkey,mask):
+        """A new entry with the masks of `entry` and `mask` under mkey,
+        replacing the cached entry of key unless key is None.  The masks
+        that other requests added to the cached entry meanwhile are kept."""
+        with self.lock:
+            current = self.entries.get(key) if key is not None else None
+            if current is not None: entry = current
+            masks = dict(entry['masks'])
+            masks[mkey] = mask
+            entry = dict(entry,masks=masks)
+            if key is not None: self.insert(key,entry)
+            return entry
+    def insert(self,key,entry):
+        # put(), with the lock held
+        if key in self.entries:
+            del self.entries[key]
+            self.nbytes -= self.sizes.pop(key)
+        size = self.size(entry)
+        if size>self.maxbytes: return
+        self.entries[key] = entry
+        self.sizes[key] = size
+        self.nbytes += size
+        while self.nbytes>self.maxbytes:
+            evicted,_ = self.entries.popitem(last=False)
+            self.nbytes -= self.sizes.pop(evicted)
+
+flat_cache = FlatCache(getattr(settings,'FLAT_CACHE_BYTES',0))
+
+# digests of the image files of the latest multi-page requests, by (path, size, mtime)
+file_digests = OrderedDict()
+
+def image_digest(imagepath):
+    """SHA-1 of the bytes of an image file, given by path or file object.
+    A page of a multi-page file, given as (path, pageno), is identified by
+    the digest of the file, which is computed once for all its pages."""
+    if type(imagepath)==tuple:
+        path,pageno = imagepath
+        info = os.stat(path)
+        key = (path,info.st_size,info.st_mtime)
+        if key not in file_digests:
+            file_digests[key] = image_digest(path)
+            while len(file_digests)>16: file_digests.popitem(last=False)
+        return "%s:%d" % (file_digests[key],pageno)
+    digest = hashlib.sha1()
+    stream = imagepath if hasattr(imagepath,'read') else open(imagepath,'rb')
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1<<20),b''):
+        digest.update(chunk)
+    stream.seek(0)
+    if stream is not imagepath: stream.close()
+    return digest.hexdigest()
 
-    if not args['nocheck']:
-        check = check_page(amax(image)-image)
-        if check is not None:
-            logger.error(imagepath+"SKIPPED"+check+"(use -n to disable this check)")
+def flat_cache_key(imagepath):
+    return (image_digest(imagepath),)+tuple(args[k] for k in flat_parameters)
+
+
+def decode_page(imagepath,dtype,half=0):
+    """Decodes the page as `args['decode']` says and normalizes it to
+    [0,1].  Returns (image, half resolution image or None), or None if the
+    page is empty or fails check_page()."""
+    with timer.span("decode"):
+        if args['decode']=='luma' and half:
+            raw,half = ocrolib.read_image_luma(imagepath,dtype=dtype,half=1)
+        elif args['decode']=='luma':
+            raw,half = ocrolib.read_image_luma(imagepath,dtype=dtype),None
+        else:
+            raw,half = ocrolib.read_image_gray(imagepath,dtype=dtype),None
+
+    # perform image normalization
+    with timer.span("normalize"):
+        image = raw-amin(raw)
+        if amax(image)==amin(image):
+            logger.info("# image is empty: %s" % (imagepath,))
             return
+        if half is not None:
+            half -= amin(raw)
+            half /= amax(image)
+        image /= amax(image)
 
-    # flatten the image by estimating the local whitelevel
-    comment = ""
-    # if not, we need to flatten it by estimating the local whitelevel
-    logger.info("flattening")
-    m = interpolation.zoom(image,args['zoom'])
-    m = filters.percentile_filter(m,args['perc'],size=(args['range'],2))
-    m = filters.percentile_filter(m,args['perc'],size=(2,args['range']))
-    m = interpolation.zoom(m,1.0/args['zoom'])
-    w,h = minimum(array(image.shape),array(m.shape))
-    flat = clip(image[:w,:h]-m[:w,:h]+1,0,1)
+        if not args['nocheck']:
+            check = check_page(amax(image)-image)
+            if check is not None:
+                logger.error("%s SKIPPED %s (use -n to disable this check)" % (imagepath, check))
+                return
+    return image,half
 
-    # estimate skew angle and rotate
-    if args['maxskew']>0:
-        logger.info("estimating skew angle")
+def deskew_page(flat):
+    """Estimates the skew angle of the page (background near 1) and rotates
+    it.  Returns the deskewed page and the angle."""
+    if args['maxskew']<=0:
+        return flat,0
+    logger.info("estimating skew angle")
+    with timer.span("skew"):
         d0,d1 = flat.shape
         o0,o1 = int(args['bignore']*d0),int(args['bignore']*d1)
         flat = amax(flat)-flat
@@ -150,40 +436,142 @@ def process(imagepath):
         est = flat[o0:d0-o0,o1:d1-o1]
         ma = args['maxskew']
         ms = int(2*args['maxskew']*args['skewsteps'])
-        angle = estimate_skew_angle(est,linspace(-ma,ma,ms+1))
+        if args['skewmethod']=='rotate':
+            angle = estimate_skew_angle(est,linspace(-ma,ma,ms+1))
+        else:
+            angle = estimate_skew_angle_sheared(est,linspace(-ma,ma,ms+1))
         flat = interpolation.rotate(flat,angle,mode='constant',reshape=0)
         flat = amax(flat)-flat
+    return flat,angle
+
+def flatten_page(imagepath):
+    """Normalizes, flattens and deskews the page.  Returns the flat page
+    (background near 1) and the skew angle, or None if the page is empty
+    or fails check_page()."""
+    # the background is estimated from the half resolution page
+    page = decode_page(imagepath,ftype(),half=args['zoom']==0.5)
+    if page is None: return
+    image,half = page
+
+    # flatten the image by estimating the local whitelevel
+    # if not, we need to flatten it by estimating the local whitelevel
+    logger.info("flattening")
+    with timer.span("flatten"):
+        m = half if half is not None else interpolation.zoom(image,args['zoom'])
+        if args['flatmethod']=='histogram':
+            m = percentile_filter_hist(m,args['perc'],(args['range'],2))
+            m = percentile_filter_hist(m,args['perc'],(2,args['range']))
+        else:
+            m = filters.percentile_filter(m,args['perc'],size=(args['range'],2))
+            m = filters.percentile_filter(m,args['perc'],size=(2,args['range']))
+        m = interpolation.zoom(m,1.0/args['zoom'])
+        w,h = minimum(array(image.shape),array(m.shape))
+        flat = clip(image[:w,:h]-m[:w,:h]+1,0,1)
+
+    # estimate skew angle and rotate
+    return deskew_page(flat)
+
+def threshold_region(flat):
+    """The flat page without the `bignore` border (a view)."""
+    d0,d1 = flat.shape
+    o0,o1 = int(args['bignore']*d0),int(args['bignore']*d1)
+    return flat[o0:d0-o0,o1:d1-o1]
+
+def threshold_mask(flat):
+    """The mask of the pixels of threshold_region(flat) that lo and hi are
+    estimated from, or None for all of them (`escale` is 0)."""
+    if args['escale']<=0: return None
+    est = threshold_region(flat)
+    # by default, we use only regions that contain
+    # significant variance; this makes the percentile
+    # based low and high estimates more reliable
+    if args['maskmethod']=='decimated':
+        return variance_mask_decimated(est,args['escale'])
+    return variance_mask(est,args['escale'])
+
+def threshold_percentiles(flat,mask,pers):
+    """The percentiles of the pixels of the flat page given by mask (see
+    threshold_mask()).  numpy.partition() needs one copy of the pixels,
+    since the flat page is thresholded afterwards; this copy is the
+    boolean-indexed one, or a flat copy partitioned in place."""
+    est = threshold_region(flat)
+    if mask is None:
+        return ocrolib.percentiles(est.flatten(),pers,overwrite=1)
+    return ocrolib.percentiles(est,pers,mask=mask)
+
+def variance_mask(est,e):
+    """Mask of the regions of est with significant variance, dilated by
+    about e*50 pixels, for the threshold estimation."""
+    v = est-filters.gaussian_filter(est,e*20.0)
+    v = filters.gaussian_filter(v**2,e*20.0)**0.5
+    v = (v>0.3*amax(v))
+    v = morphology.binary_dilation(v,structure=ones((int(e*50),1)))
+    v = morphology.binary_dilation(v,structure=ones((1,int(e*50))))
+    return v
+
+def mask_decimation(e):
+    """Decimation factor of variance_mask_decimated() for escale e."""
+    return max(1,min(4,int(4*e)))
+
+def variance_mask_decimated(est,e):
+    """variance_mask() computed on est decimated by mask_decimation(e),
+    with the filter and dilation sizes scaled down accordingly.  The
+    boolean mask is upsampled by repeating its pixels, and the rows and
+    columns dropped by the decimation are taken from the nearest ones."""
+    f = mask_decimation(e)
+    if f==1 or min(est.shape)<2*f: return variance_mask(est,e)
+    small = decimate(est,f)
+    v = small-filters.gaussian_filter(small,e*20.0/f)
+    v = filters.gaussian_filter(v**2,e*20.0/f)**0.5
+    v = (v>0.3*amax(v))
+    r = max(1,int(round(e*50.0/f)))
+    v = morphology.binary_dilation(v,structure=ones((r,1)))
+    v = morphology.binary_dilation(v,structure=ones((1,r)))
+    v = v.repeat(f,axis=0).repeat(f,axis=1)
+    return pad(v,[(0,est.shape[0]-v.shape[0]),(0,est.shape[1]-v.shape[1])],'edge')
+
+def mask_key():
+    """Key of the threshold mask of a cache entry, for the mask parameters."""
+    return args['escale'],args['maskmethod']
+
+def flat_page(imagepath):
+    """The cache entry of the flattened page (see FlatCache), computing it
+    on a cache miss.  Returns None if the page cannot be flattened."""
+    key = flat_cache_key(imagepath) if flat_cache.maxbytes>0 else None
+    entry = flat_cache.get(key) if key is not None else None
+    if entry is None:
+        page = flatten_page(imagepath)
+        if page is None: return
+        flat,angle = page
+        entry = dict(flat=flat,angle=angle,masks={})
     else:
-        angle = 0
+        logger.info("flattened page found in cache")
 
     # estimate low and high thresholds
     logger.info("estimating thresholds")
-    d0,d1 = flat.shape
-    o0,o1 = int(args['bignore']*d0),int(args['bignore']*d1)
-    est = flat[o0:d0-o0,o1:d1-o1]
-    if args['escale']>0:
-        # by default, we use only regions that contain
-        # significant variance; this makes the percentile
-        # based low and high estimates more reliable
-        e = args['escale']
-        v = est-filters.gaussian_filter(est,e*20.0)
-        v = filters.gaussian_filter(v**2,e*20.0)**0.5
-        v = (v>0.3*amax(v))
-        v = morphology.binary_dilation(v,structure=ones((int(e*50),1)))
-        v = morphology.binary_dilation(v,structure=ones((1,int(e*50))))
-        est = est[v]
-    lo = stats.scoreatpercentile(est.ravel(),args['lo'])
-    hi = stats.scoreatpercentile(est.ravel(),args['hi'])
+    if mask_key() not in entry['masks']:
+        with timer.span("thresholds"):
+            mask = threshold_mask(entry['flat'])
+        entry = flat_cache.add_mask(key,entry,mask_key(),mask)
+    return entry
+
+def threshold_page(entry,lo,hi,threshold):
+    """Rescales the flattened page of a cache entry between the lo and hi
+    percentiles of its threshold pixels, and thresholds it.  The entry is
+    not modified.  Returns the binary page as a PIL image."""
+    flat,angle = entry['flat'],entry['angle']
+    with timer.span("thresholds"):
+        lo,hi = threshold_percentiles(flat,entry['masks'][mask_key()],[lo,hi])
     # rescale the image to get the gray scale image
     logger.info("rescaling")
-    flat -= lo
-    flat /= (hi-lo)
-    flat = clip(flat,0,1)
-    bin = 1*(flat>args['threshold'])
+    with timer.span("rescale"):
+        flat = flat-lo
+        flat /= (hi-lo)
+        flat = clip(flat,0,1)
+        bin = (flat>threshold)
 
-    
     # output the normalized grayscale and the thresholded image
-    logger.info("%s lo-hi (%.2f %.2f) angle %4.1f %s" % (imagepath, lo, hi, angle, comment))
+    logger.info("lo-hi (%.2f %.2f) angle %4.1f" % (lo, hi, angle))
     logger.info("writing")
 
     """
@@ -195,9 +583,471 @@ def process(imagepath):
     """
     
     ### Return image object directly (in memory)
+    with timer.span("rescale"):
+        return binary_page(bin)
+
+def binary_page(bin):
+    """The PIL image of a binary page (True is white)."""
     assert bin.ndim==2
     midrange = 0.5*(amin(bin)+amax(bin))
     image_array = array(255*(bin>midrange),'B') # wrong if call "ocrlib.midrange()"
     image_pil = array2pil(image_array)  # wrong if call "ocrlib.array2pil()"
     return image_pil
+
+def process(imagepath):
+    logger.info("# %s" % (imagepath,))
+    if args['algorithm']!='nlbin':
+        return process_local(imagepath)
+    if args['maxmem']>0:
+        return process_tiled(imagepath)
+    entry = flat_page(imagepath)
+    if entry is None: return
+    return threshold_page(entry,args['lo'],args['hi'],args['threshold'])
+
+def process_sweep(imagepath,thresholds,percentiles):
+    """Binarizes the page with every threshold for every (lo,hi) pair of
+    percentiles, flattening and deskewing it and computing its escale
+    mask only once.  Returns a list of ((lo,hi,threshold),image)."""
+    logger.info("# %s sweep" % (imagepath,))
+    if args['maxmem']>0:
+        return process_sweep_tiled(imagepath,thresholds,percentiles)
+    outputs = []
+    entry = flat_page(imagepath)
+    if entry is None: return
+    for lo,hi in percentiles:
+        for threshold in thresholds:
+            image = threshold_page(entry,lo,hi,threshold)
+            outputs.append(((lo,hi,threshold),image))
+    return outputs
+
+def process_sweep_tiled(imagepath,thresholds,percentiles):
+    """process_sweep() with maxmem: the page is flattened and deskewed into
+    one row store, and the percentiles of all the (lo,hi) pairs are
+    selected in the same passes over it."""
+    page = flatten_tiled(imagepath)
+    if page is None: return
+    flat,read_flat,angle = page
+    try:
+        values = tiled_percentiles(read_flat,flat.shape,[p for pair in percentiles for p in pair])
+        outputs = []
+        for i,(lo,hi) in enumerate(percentiles):
+            for threshold in thresholds:
+                image = threshold_tiled(read_flat,flat.shape,values[2*i],values[2*i+1],threshold)
+                outputs.append(((lo,hi,threshold),image))
+        return outputs
+    finally:
+        flat.close()
     
+
+
+################################################################
+### Local (Sauvola and Niblack) thresholding.
+###
+### Instead of flattening the page and thresholding it globally, each
+### pixel is compared with a threshold computed from the mean m and the
+### standard deviation s of the `window` x `window` pixels around it:
+###
+###     sauvola: m*(1+k*(s/R-1)), with R=0.5 the largest s of [0,1] pixels
+###     niblack: m-k*s
+###
+### m and s come from summed area tables of the pixels and of their
+### squares, so each pixel costs the same four lookups whatever the
+### window size.
+################################################################
+
+# bytes per pixel of a strip: two float64 tables, their four corner
+# lookups and the float32 mean, deviation and threshold
+local_bytes = 64
+# rows per strip without a memory budget: the strip tables stay in cache,
+# which makes strips faster than whole page tables
+local_strip = 256
+
+def summed_area_table(image):
+    """The (h+1,w+1) table of the sums of image[:i,:j].  The sums are kept
+    in float64, since the variance of flat regions is lost in the
+    difference of large float32 sums."""
+    table = zeros((image.shape[0]+1,image.shape[1]+1),'d')
+    cumsum(image,axis=0,out=table[1:,1:])
+    cumsum(table[1:,1:],axis=1,out=table[1:,1:])
+    return table
+
+def local_rows(w,r):
+    """Rows per strip of local_threshold() for the memory budget."""
+    if args['maxmem']<=0: return local_strip
+    rows = int(args['maxmem']*2**20/(local_bytes*w))-2*r
+    if rows<16:
+        logger.warning("maxmem %dMB is too small for %d pixel wide rows, using 16 row strips" % (args['maxmem'], w))
+        rows = 16
+    return rows
+
+def local_threshold(image,window,k,algorithm,rows=0):
+    """Thresholds the page against the Sauvola or Niblack threshold of the
+    window around each pixel, clipping windows at the page border.  With
+    `rows`, the tables are computed for strips of that many rows (plus the
+    half window above and below them) at a time.  Returns the binary page
+    (True is white)."""
+    h,w = image.shape
+    r = window//2
+    d = 2*r+1
+    rows = rows or h
+    bin = zeros((h,w),bool)
+    nx = clip(arange(w)+r+1,0,w)-clip(arange(w)-r,0,w)
+    for r0,r1 in strips(h,rows):
+        a0,a1 = max(0,r0-r),min(h,r1+r)
+        strip = image[a0:a1]
+        n = r1-r0
+        ny = clip(arange(r0,r1)+r+1,0,h)-clip(arange(r0,r1)-r,0,h)
+        area = outer(ny,nx).astype('f')
+        # repeating the first and last rows and columns of the tables
+        # clips the windows, and turns the corners into shifted slices
+        pads = ((r-(r0-a0),r1+r-a1),(r,r+1))
+        def box(table):
+            table = pad(table,pads,mode='edge')
+            a = table[d:d+n,d:d+w]-table[:n,d:d+w]
+            a -= table[d:d+n,:w]
+            a += table[:n,:w]
+            return array(a,'f')/area
+        m = box(summed_area_table(strip))
+        s = box(summed_area_table(strip*strip))-m*m
+        s = sqrt(maximum(s,0,out=s),out=s)
+        if algorithm=='sauvola':
+            t = m*(1+k*(s/float32(0.5)-1))
+        else:
+            t = m-float32(k)*s
+        bin[r0:r1] = image[r0:r1]>t
+    return bin
+
+def process_local(imagepath):
+    """Binarizes the page with local_threshold(), after the decoding,
+    normalization and deskewing of process().  The pipeline is float32
+    whatever `precision` is."""
+    page = decode_page(imagepath,'f')
+    if page is None: return
+    image,_ = page
+    image,angle = deskew_page(image)
+    logger.info("%s window %d k %.2f angle %4.1f" % (args['algorithm'], args['window'], args['k'], angle))
+    with timer.span("thresholds"):
+        image = array(image,'f')
+        bin = local_threshold(image,args['window'],args['k'],args['algorithm'],
+                              rows=local_rows(image.shape[1],args['window']//2))
+    with timer.span("rescale"):
+        return binary_page(bin)
+
+
+################################################################
+### Tiled processing of large pages.
+###
+### process_tiled() computes the same output as process(), but it
+### only keeps a few horizontal strips of floating point data in memory.
+### Full-page intermediates are kept in temporary files, and each
+### strip is computed from enough extra rows (its halo) that filters
+### and interpolations see the same data as on the whole page.
+################################################################
+
+# page rows alive at once per strip row, for the memory budget
+strip_temporaries = 12
+# rows after which the cubic spline prefilter no longer sees a strip border
+spline_halo = 32
+
+class RowStore:
+    """The rows of a floating point page, kept in a temporary file."""
+    def __init__(self,shape,dtype='d'):
+        self.shape = shape
+        self.dtype = numpy.dtype(dtype)
+        self.stream = tempfile.TemporaryFile()
+    def write(self,r0,rows):
+        self.stream.seek(r0*self.shape[1]*self.dtype.itemsize)
+        array(rows,self.dtype).tofile(self.stream)
+    def read(self,r0,r1):
+        self.stream.seek(r0*self.shape[1]*self.dtype.itemsize)
+        rows = fromfile(self.stream,self.dtype,(r1-r0)*self.shape[1])
+        return rows.reshape(r1-r0,self.shape[1])
+    def close(self):
+        self.stream.close()
+
+def strips(n,height):
+    for r0 in range(0,n,height):
+        yield r0,min(n,r0+height)
+
+def strip_height(w,halo):
+    """Rows per strip that fit the memory budget given the halo rows."""
+    itemsize = numpy.dtype(ftype()).itemsize
+    rows = int(args['maxmem']*2**20/(strip_temporaries*itemsize*w))-2*halo
+    if rows<16:
+        logger.warning("maxmem %dMB is too small for %d pixel wide rows, using 16 row strips" % (args['maxmem'], w))
+        rows = 16
+    return rows
+
+def zoom_factor(n,m):
+    """The coordinate scale interpolation.zoom() uses from n to m pixels."""
+    return (n-1.0)/(m-1.0) if m>1 else 1.0
+
+def support(o0,o1,f,n,halo):
+    """Input rows needed for output rows o0..o1 of a transform scaling
+    row coordinates by f, with `halo` extra rows on each side."""
+    return max(0,int(f*o0)-halo),min(n,int(f*(o1-1))+halo+2)
+
+def zoom_strip(strip,s0,f,o0,o1,width):
+    """Rows o0..o1 of interpolation.zoom() of a page, from the page rows
+    starting at s0 in `strip`; f are the zoom_factor()s of both axes."""
+    return interpolation.affine_transform(strip,diag(f),offset=(f[0]*o0-s0,0),
+                                          output_shape=(o1-o0,width),mode='constant')
+
+def sortable_keys(values):
+    """Map float64 values to uint64 keys with the same ordering."""
+    u = array(values,'d').view('u8')
+    return where(u>>uint64(63),~u,u|uint64(1<<63))
+
+def key_values(keys):
+    u = array(keys,'u8')
+    return where(u>>uint64(63),u&~uint64(1<<63),~u).view('d')
+
+def streamed_percentiles(stream,pers,limit=1<<20):
+    """Compute stats.scoreatpercentile() of the concatenation of all the
+    arrays yielded by stream() for each percentile in `pers`, without
+    holding the values in memory.  Each pass over the stream histograms the
+    next 16 bits of the order-preserving keys of the values around the
+    wanted ranks; once at most `limit` candidates are left, they are
+    collected and sorted in a final pass, so the result is exact."""
+    counts,n = zeros(1<<16,'int64'),0
+    for values in stream():
+        keys = sortable_keys(values.ravel())
+        counts += bincount(array(keys>>uint64(48),'i'),minlength=1<<16)
+        n += len(keys)
+    weights = []
+    ranks = set()
+    for per in pers:
+        idx = per/100.*(n-1)
+        i = int(idx)
+        if i==idx: weights.append(([i],array([1.0])))
+        else: weights.append(([i,i+1],array([i+1-idx,idx-i])))
+        ranks.update(weights[-1][0])
+    # rank -> [prefix bits, prefix, rank among the keys with that prefix]
+    state = {}
+    for k in ranks:
+        c = cumsum(counts)
+        d = searchsorted(c,k,side='right')
+        state[k] = [16,d,k-(c[d]-counts[d]),counts[d]]
+    result = {}
+    while len(result)<len(ranks):
+        pending = [k for k in ranks if k not in result]
+        collect = dict((k,state[k][3]<=limit or state[k][0]==64) for k in pending)
+        hists = dict((k,zeros(1<<16,'int64')) for k in pending)
+        found = dict((k,[]) for k in pending)
+        for values in stream():
+            keys = sortable_keys(values.ravel())
+            for k in pending:
+                bits,prefix,_,_ = state[k]
+                sel = keys[(keys>>uint64(64-bits))==uint64(prefix)]
+                if collect[k]: found[k].append(sel)
+                else: hists[k] += bincount(array((sel>>uint64(48-bits))&uint64(0xffff),'i'),minlength=1<<16)
+        for k in pending:
+            bits,prefix,r,_ = state[k]
+            if collect[k]:
+                result[k] = sort(concatenate(found[k]))[r]
+                continue
+            c = cumsum(hists[k])
+            d = searchsorted(c,r,side='right')
+            state[k] = [bits+16,(prefix<<16)|int(d),r-(c[d]-hists[k][d]),hists[k][d]]
+    values = key_values([result[k] for k in sorted(ranks)])
+    values = dict(zip(sorted(ranks),values))
+    return [add.reduce(array([values[i] for i in r])*w)/w.sum() for r,w in weights]
+
+def estimate_skew_angle_tiled(read,shape,angles,height,coarse=1024):
+    """estimate_skew_angle_sheared() of the page whose rows r0..r1 are
+    returned by read(r0,r1), working on strips of `height` rows."""
+    h,w = shape
+    angles = sorted(angles)
+    n = len(angles)
+    stride = max(1,int(sqrt(n)))
+    f = max(1,max(shape)//coarse)
+    small = concatenate([decimate(read(r0,r1),f) for r0,r1 in strips(h//f*f,max(f,height//f*f))])
+    csum = c_[zeros(small.shape[0]),cumsum(small,axis=1,dtype='d')]
+    estimates = [(sheared_profile_variance(csum,angles[i]),i) for i in range(0,n,stride)]
+    _,best = max(estimates)
+    candidates = range(max(0,best-stride+1),min(n,best+stride))
+    profiles = dict((i,0) for i in candidates)
+    for r0,r1 in strips(h,height):
+        strip = read(r0,r1)
+        csum = c_[zeros(strip.shape[0]),cumsum(strip,axis=1,dtype='d')]
+        for i in candidates:
+            span = int(abs(rint((w-1)*tan(radians(angles[i])))))
+            profiles[i] = profiles[i]+sheared_profile(csum,angles[i],row0=r0,length=h+span)
+    estimates = [(profile_variance(profiles[i],h,w,angles[i]),angles[i]) for i in candidates]
+    _,a = max(estimates)
+    return a
+
+def process_tiled(imagepath):
+    """process() in horizontal strips, keeping the floating point working set
+    within args['maxmem'] MB.  The decoded upload, as PIL holds it (one
+    byte per pixel for gray pages, four for color pages), and the binary
+    output (one byte per pixel) are held in memory in addition."""
+    page = flatten_tiled(imagepath)
+    if page is None: return
+    flat,read_flat,angle = page
+    try:
+        lo,hi = tiled_percentiles(read_flat,flat.shape,[args['lo'],args['hi']])
+        logger.info("%s lo-hi (%.2f %.2f) angle %4.1f" % (imagepath, lo, hi, angle))
+        return threshold_tiled(read_flat,flat.shape,lo,hi,args['threshold'])
+    finally:
+        flat.close()
+
+def flatten_tiled(imagepath):
+    """The normalized, flattened and deskewed page of process_tiled(), as
+    (RowStore, function returning its rows r0..r1 with the background near
+    1, skew angle).  Returns None if the page is empty.  Only the sheared
+    skew estimator and the full resolution escale mask are implemented
+    (the parameter serializer rejects the others with maxmem)."""
+    if args['skewmethod']=='rotate' or args['maskmethod']=='decimated':
+        raise Exception("skewmethod rotate and maskmethod decimated are not available with maxmem")
+    with timer.span("decode"):
+        pil = ocrolib.open_image(imagepath)
+        if args['decode']=='luma': pil = ocrolib.pil_luma(pil)
+        pil.load()
+        W,H = pil.size
+    def gray(r0,r1):
+        # the rows of ocrolib.read_image_gray(imagepath), converted from
+        # the PIL image one strip at a time
+        a = numpy.divide(ocrolib.pil2array(pil.crop((0,r0,W,r1))),255.0,dtype=ftype())
+        if a.ndim==3: a = mean(a,2,dtype=ftype())
+        return a
+
+    # perform image normalization
+    with timer.span("normalize"):
+        height = strip_height(W,0)
+        lo = min(amin(gray(r0,r1)) for r0,r1 in strips(H,height))
+        hi = max(amax(gray(r0,r1)-lo) for r0,r1 in strips(H,height))
+    if hi==0:
+        logger.info("# image is empty: %s" % (imagepath,))
+        return
+    def image(r0,r1):
+        a = gray(r0,r1)-lo
+        a /= hi
+        return a
+
+    # flatten the image by estimating the local whitelevel
+    logger.info("flattening (tiled)")
+    with timer.span("flatten"):
+        z = args['zoom']
+        zh,zw = int(round(H*z)),int(round(W*z))
+        mh,mw = int(round(zh*(1.0/z))),int(round(zw*(1.0/z)))
+        f1 = (zoom_factor(H,zh),zoom_factor(W,zw))
+        f2 = (zoom_factor(zh,mh),zoom_factor(zw,mw))
+        d0,d1 = min(H,mh),min(W,mw)
+        flat = RowStore((d0,d1),ftype())
+        fmax = -inf
+        R = args['range']
+        for y0,y1 in strips(d0,strip_height(W,int((R+2*spline_halo)/z)+spline_halo)):
+            c0,c1 = support(y0,y1,f2[0],zh,spline_halo)
+            b0,b1 = max(0,c0-R),min(zh,c1+R)
+            s0,s1 = support(b0,b1,f1[0],H,spline_halo)
+            s0,s1 = min(s0,y0),max(s1,y1)
+            strip = image(s0,s1)
+            m = zoom_strip(strip,s0,f1,b0,b1,zw)
+            if args['flatmethod']=='histogram':
+                m = percentile_filter_hist(m,args['perc'],(R,2))
+                m = percentile_filter_hist(m,args['perc'],(2,R))
+            else:
+                m = filters.percentile_filter(m,args['perc'],size=(R,2))
+                m = filters.percentile_filter(m,args['perc'],size=(2,R))
+            m = zoom_strip(m[c0-b0:c1-b0],c0,f2,y0,y1,mw)
+            rows = clip(strip[y0-s0:y1-s0,:d1]-m[:,:d1]+1,0,1)
+            fmax = max(fmax,amax(rows))
+            flat.write(y0,rows)
+        del strip,m,rows
+
+    # estimate skew angle and rotate
+    o0,o1 = int(args['bignore']*d0),int(args['bignore']*d1)
+    if args['maxskew']>0:
+        logger.info("estimating skew angle (tiled)")
+        with timer.span("skew"):
+            ma = args['maxskew']
+            ms = int(2*args['maxskew']*args['skewsteps'])
+            read = lambda r0,r1: fmax-flat.read(o0+r0,o0+r1)[:,o1:d1-o1]
+            angle = estimate_skew_angle_tiled(read,(d0-2*o0,d1-2*o1),linspace(-ma,ma,ms+1),strip_height(d1,0))
+            # interpolation.rotate(flat,angle,mode='constant',reshape=0), by strips
+            t = numpy.pi/180*angle
+            matrix = array([[math.cos(t),math.sin(t)],[-math.sin(t),math.cos(t)]])
+            center = array([d0/2.0-0.5,d1/2.0-0.5])
+            offset = center-dot(matrix,center)
+            rotated = RowStore((d0,d1),ftype())
+            rmax = -inf
+            span = int(ceil(abs((d1-1)*matrix[0,1])))
+            for y0,y1 in strips(d0,strip_height(d1,span//2+spline_halo)):
+                ys = [dot(matrix[0],(y,x))+offset[0] for y in (y0,y1-1) for x in (0,d1-1)]
+                s0,s1 = max(0,int(floor(min(ys)))-spline_halo),min(d0,int(ceil(max(ys)))+spline_halo+1)
+                rows = interpolation.affine_transform(fmax-flat.read(s0,s1),matrix,
+                                                      offset=dot(matrix,(y0,0))+offset-(s0,0),
+                                                      output_shape=(y1-y0,d1),mode='constant')
+                rmax = max(rmax,amax(rows))
+                rotated.write(y0,rows)
+            del rows
+            flat.close()
+            flat = rotated
+            read_flat = lambda r0,r1: rmax-flat.read(r0,r1)
+    else:
+        angle = 0
+        read_flat = flat.read
+    return flat,read_flat,angle
+
+def tiled_percentiles(read_flat,shape,pers):
+    """The percentiles of the flattened page of flatten_tiled() that lo
+    and hi are estimated from (see threshold_mask()), read by strips."""
+    logger.info("estimating thresholds (tiled)")
+    d0,d1 = shape
+    o0,o1 = int(args['bignore']*d0),int(args['bignore']*d1)
+    with timer.span("thresholds"):
+        he,we = d0-2*o0,d1-2*o1
+        read_est = lambda r0,r1: read_flat(o0+r0,o0+r1)[:,o1:d1-o1]
+        if args['escale']>0:
+            # the variance mask of process(), computed by strips
+            e = args['escale']
+            r = int(4.0*e*20.0+0.5)
+            v = RowStore((he,we),ftype())
+            vmax = -inf
+            for a0,a1 in strips(he,strip_height(we,2*r)):
+                s0,s1 = max(0,a0-2*r),min(he,a1+2*r)
+                est = read_est(s0,s1)
+                rows = est-filters.gaussian_filter(est,e*20.0)
+                rows = filters.gaussian_filter(rows**2,e*20.0)**0.5
+                rows = rows[a0-s0:a1-s0]
+                vmax = max(vmax,amax(rows))
+                v.write(a0,rows)
+            del est,rows
+            L = int(e*50)
+            height = strip_height(we,L)
+            def stream():
+                for a0,a1 in strips(he,height):
+                    s0,s1 = max(0,a0-L),min(he,a1+L)
+                    mask = (v.read(s0,s1)>0.3*vmax)
+                    mask = morphology.binary_dilation(mask,structure=ones((L,1)))
+                    mask = morphology.binary_dilation(mask,structure=ones((1,L)))
+                    yield read_est(a0,a1)[mask[a0-s0:a1-s0]]
+        else:
+            height = strip_height(we,0)
+            def stream():
+                for a0,a1 in strips(he,height):
+                    yield read_est(a0,a1)
+        values = streamed_percentiles(stream,pers)
+        if args['escale']>0: v.close()
+    return values
+
+def threshold_tiled(read_flat,shape,lo,hi,threshold):
+    """Rescales the flattened page of flatten_tiled() between lo and hi and
+    thresholds it, by strips.  Returns the binary page as a PIL image."""
+    logger.info("rescaling (tiled)")
+    d0,d1 = shape
+    with timer.span("rescale"):
+        image_array = zeros((d0,d1),'B')
+        ones_seen,zeros_seen = 0,0
+        for y0,y1 in strips(d0,strip_height(d1,0)):
+            rows = read_flat(y0,y1)
+            rows -= lo
+            rows /= (hi-lo)
+            rows = clip(rows,0,1)
+            bin = (rows>threshold)
+            ones_seen,zeros_seen = ones_seen or bin.any(),zeros_seen or not bin.all()
+            image_array[y0:y1] = 255*bin
+        # process() thresholds its binary output at its midrange
+        if not (ones_seen and zeros_seen): image_array[:,:] = 0
+        return array2pil(image_array)
@@ -18,5 +18,15 @@ class Parameters(models.Model):
 	lo = models.FloatField(default=5.0, help_text="percentile for black estimation")
 	hi = models.FloatField(default=90.0, help_text="percentile for white estimation")
 	skewsteps = models.IntegerField(default=8, help_text="steps for skew angle estimation (per degree)")
+	skewmethod = models.CharField(max_length=10, default="shear", choices=(("shear", "shear"), ("rotate", "rotate")), help_text="skew angle estimation method: coarse-to-fine sheared projections, or full page rotations (reference)")
+	flatmethod = models.CharField(max_length=10, default="scipy", choices=(("scipy", "scipy"), ("histogram", "histogram")), help_text="percentile filter for background flattening: exact scipy filter, or quantized sliding histograms (faster)")
+	maxmem = models.IntegerField(default=0, help_text="memory budget (MB) for binarizing large pages in horizontal strips (0=whole page at once)")
+	precision = models.CharField(max_length=10, default="float64", choices=(("float64", "float64"), ("float32", "float32")), help_text="floating point precision of the pipeline; float32 halves memory traffic, output pixels only differ where the float64 rescaled value is within 1e-5 of threshold")
+	decode = models.CharField(max_length=10, default="mean", choices=(("mean", "mean"), ("luma", "luma")), help_text="grayscale of color images: mean of the channels, or luma decoded by PIL (JPEGs decoded to grayscale, with a half resolution page for the background estimate when zoom=0.5)")
+	maskmethod = models.CharField(max_length=10, default="full", choices=(("full", "full"), ("decimated", "decimated")), help_text="resolution of the escale text region mask; decimated computes it on the page shrunk by 4*escale, at most 4")
+	algorithm = models.CharField(max_length=10, default="nlbin", choices=(("nlbin", "nlbin"), ("sauvola", "sauvola"), ("niblack", "niblack")), help_text="binarizer: flattened page with global thresholds (ocropus-nlbin), or the Sauvola or Niblack threshold of the window around each pixel")
+	window = models.IntegerField(default=31, help_text="window size (pixels) of the sauvola and niblack algorithms")
+	k = models.FloatField(default=0.2, help_text="weight of the window standard deviation in the sauvola and niblack thresholds")
+	output_format = models.CharField(max_length=10, default="png", choices=(("png", "png"), ("png1", "png1"), ("tiffg4", "tiffg4"), ("packbits", "packbits")), help_text="encoding of the output: 8-bit PNG, 1-bit PNG, CCITT G4 TIFF, or the packed bits of ocrolib.pack_binary()")
 
 	#parallel = models.IntegerField(default=0, help_text="number of parallel CPUs to use")
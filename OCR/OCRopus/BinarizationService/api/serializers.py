@@ -7,4 +7,13 @@ class ParameterSerializer(serializers.ModelSerializer):
 	class Meta:
 		model = Parameters
 		fields = ('id', 'threshold', 'zoom', 'escale', 'bignore', 'perc', 
-			'range', 'maxskew', 'lo', 'hi', 'skewsteps')
\ No newline at end of file
+			'range', 'maxskew', 'lo', 'hi', 'skewsteps', 'skewmethod', 'flatmethod', 'maxmem', 'precision', 'decode', 'maskmethod', 'algorithm', 'window', 'k', 'output_format')
+
+	def validate(self, data):
+		# the tiled mode (maxmem) implements only the sheared skew estimator and the full resolution mask
+		if data.get('maxmem', 0) > 0 and data.get('algorithm', 'nlbin') == 'nlbin':
+			if data.get('skewmethod', 'shear') == 'rotate':
+				raise serializers.ValidationError("skewmethod rotate is not available with maxmem")
+			if data.get('maskmethod', 'full') == 'decimated':
+				raise serializers.ValidationError("maskmethod decimated is not available with maxmem")
+		return data
@@ -2,5 +2,443 @@
 from __future__ import unicode_literals
 
 from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from scipy.ndimage import filters, interpolation
+from scipy import stats
+from numpy import *
+import os, io, time, logging, zipfile, tempfile
+import PIL.Image, PIL.ImageOps
+from multiprocessing.pool import ThreadPool
+import ocrolib
+from api import binarization
+from api.models import Parameters
+from api.serializers import ParameterSerializer
 
-# Create your tests here.
+logger = logging.getLogger('django')
+testImage = os.path.join(settings.BASE_DIR, 'testimages', 'NY01075759_lg.jpg')
+
+def default_parameters(**kw):
+    parameters = dict(ParameterSerializer(Parameters()).data)
+    parameters.update(kw)
+    return parameters
+
+def normalized_page(path):
+    image = ocrolib.read_image_gray(path)
+    image = image-amin(image)
+    return image/amax(image)
+
+
+class SkewTest(TestCase):
+
+    def test_sheared_estimate_within_one_step_of_rotate(self):
+        binarization.args = default_parameters(maxskew=0, nocheck=True)
+        flat, _ = binarization.flatten_page(testImage)
+        parameters = default_parameters()
+        ma, steps = parameters['maxskew'], parameters['skewsteps']
+        angles = linspace(-ma, ma, int(2*ma*steps)+1)
+        # ink near 1, as in deskew_page(), without the bignore border
+        page = amax(flat)-flat
+        d0, d1 = page.shape
+        o0, o1 = int(parameters['bignore']*d0), int(parameters['bignore']*d1)
+        for skew in [-1.5, -0.4, 0.9, 1.55]:
+            est = interpolation.rotate(page, skew, order=1, mode='constant', reshape=0)[o0:d0-o0,o1:d1-o1]
+            expected = binarization.estimate_skew_angle(est, angles)
+            result = binarization.estimate_skew_angle_sheared(est, angles)
+            logger.info("skew %g rotate %g sheared %g" % (skew, expected, result))
+            self.assertLessEqual(abs(expected+skew), 1.0/steps)
+            self.assertLessEqual(abs(result-expected), 1.0/steps+1e-9)
+
+
+class PercentileFilterTest(TestCase):
+
+    def test_matches_scipy_within_quantization(self):
+        image = filters.gaussian_filter(random.RandomState(0).rand(120,90),2)
+        bound = (amax(image)-amin(image))/(2*255.0)+1e-12
+        for size in [(20,2),(2,20),(5,5),(3,1)]:
+            expected = filters.percentile_filter(image,80,size=size)
+            result = binarization.percentile_filter_hist(image,80,size)
+            self.assertLessEqual(amax(abs(expected-result)), bound)
+
+    def test_sample_page_accuracy_and_speed(self):
+        # flattening background estimate on the bundled sample, with the
+        # default parameters (zoom=0.5, perc=80, range=20)
+        m = interpolation.zoom(normalized_page(testImage),0.5)
+        begin = time.time()
+        expected = filters.percentile_filter(m,80,size=(20,2))
+        expected = filters.percentile_filter(expected,80,size=(2,20))
+        scipy_time = time.time()-begin
+        begin = time.time()
+        result = binarization.percentile_filter_hist(m,80,(20,2))
+        result = binarization.percentile_filter_hist(result,80,(2,20))
+        hist_time = time.time()-begin
+        error = amax(abs(expected-result))
+        logger.info("percentile filter scipy %.2fs histogram %.2fs max error %.4f" % (scipy_time, hist_time, error))
+        # two quantized passes, each within half a step of 1/255
+        self.assertLessEqual(error, 2/255.0)
+
+
+class PercentilesTest(TestCase):
+
+    def test_same_as_scoreatpercentile(self):
+        values = random.RandomState(0).rand(300,200)
+        mask = values>0.3
+        pers = [5.0, 90.0, 33.3, 0, 100]
+        for dtype in ['d', 'f']:
+            a = array(values, dtype)
+            expected = [stats.scoreatpercentile(a[mask], per) for per in pers]
+            self.assertEqual(ocrolib.percentiles(a, pers, mask=mask), expected)
+            expected = [stats.scoreatpercentile(a.ravel(), per) for per in pers]
+            self.assertEqual(ocrolib.percentiles(a, pers), expected)
+            self.assertTrue((a==array(values, dtype)).all())
+
+
+class TiledBinarizationTest(TestCase):
+
+    def test_streamed_percentiles_are_exact(self):
+        values = around(random.RandomState(0).rand(50000),3)
+        chunks = lambda: (values[i:i+7000] for i in range(0,len(values),7000))
+        for limit in [1<<20,10]:
+            result = binarization.streamed_percentiles(chunks,[5.0,90.0,33.3],limit=limit)
+            expected = [stats.scoreatpercentile(values,per) for per in [5.0,90.0,33.3]]
+            self.assertEqual(result, expected)
+
+    def test_same_output_as_whole_page(self):
+        expected = binarization.binarization_exec(testImage, default_parameters())
+        result = binarization.binarization_exec(testImage, default_parameters(maxmem=100))
+        self.assertTrue((array(expected)==array(result)).all())
+
+    def test_tiled_sweep_matches_single_requests(self):
+        flatten_tiled, pages = binarization.flatten_tiled, []
+        binarization.flatten_tiled = lambda image: pages.append(image) or flatten_tiled(image)
+        try:
+            outputs = dict(binarization.binarization_sweep(testImage, default_parameters(maxmem=100), [0.4, 0.6], [(5, 90), (10, 95)]))
+        finally:
+            binarization.flatten_tiled = flatten_tiled
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(len(outputs), 4)
+        for lo, hi, threshold in [(5, 90, 0.6), (10, 95, 0.4)]:
+            expected = binarization.binarization_exec(testImage, default_parameters(lo=lo, hi=hi, threshold=threshold))
+            self.assertTrue((array(expected)==array(outputs[lo, hi, threshold])).all())
+
+    def test_methods_without_tiled_mode_are_rejected(self):
+        for kw in [dict(skewmethod='rotate'), dict(maskmethod='decimated')]:
+            with open(testImage, 'rb') as f:
+                response = self.client.post('/binarizationapi/', dict(kw, image=f, maxmem=100))
+            self.assertEqual(response.status_code, 400)
+            self.assertIsNone(binarization.binarization_exec(testImage, default_parameters(maxmem=100, **kw)))
+
+    def test_same_output_for_color_page(self):
+        color = tempfile.mktemp(suffix='.png')
+        PIL.ImageOps.colorize(PIL.Image.open(testImage), (40,30,20), (250,240,210)).save(color)
+        try:
+            expected = binarization.binarization_exec(color, default_parameters())
+            result = binarization.binarization_exec(color, default_parameters(maxmem=100))
+            self.assertTrue((array(expected)==array(result)).all())
+        finally:
+            os.remove(color)
+
+
+class PrecisionTest(TestCase):
+
+    def test_float32_output_matches_float64(self):
+        expected = array(binarization.binarization_exec(testImage, default_parameters()))
+        result = array(binarization.binarization_exec(testImage, default_parameters(precision='float32')))
+        self.assertLessEqual(sum(expected!=result), 1e-4*expected.size)
+
+    def test_float32_chooses_the_same_skew_angle(self):
+        page = PIL.Image.open(testImage).convert('L')
+        rotated = tempfile.mktemp(suffix='.png')
+        try:
+            for skew in [-1.5, 0.4, 1.3]:
+                page.rotate(skew, resample=PIL.Image.BICUBIC, fillcolor=255).save(rotated)
+                angles = []
+                for precision in ['float64', 'float32']:
+                    binarization.args = default_parameters(precision=precision, nocheck=True)
+                    angles.append(binarization.flatten_page(rotated)[1])
+                self.assertEqual(angles[0], angles[1])
+        finally:
+            os.remove(rotated)
+
+
+class BatchTest(TestCase):
+
+    def test_batch_archive_matches_single_requests(self):
+        expected = binarization.binarization_exec(testImage, default_parameters())
+        with open(testImage, 'rb') as f:
+            data = f.read()
+        images = [SimpleUploadedFile('page%d.jpg' % i, data) for i in range(3)]
+        response = self.client.post('/binarizationapi/batch', {'image': images})
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()), ['page0_bin.png', 'page1_bin.png', 'page2_bin.png'])
+        for name in archive.namelist():
+            result = PIL.Image.open(io.BytesIO(archive.read(name)))
+            self.assertTrue((array(expected)==array(result)).all())
+
+
+class OutputFormatTest(TestCase):
+
+    def test_bilevel_formats_decode_to_same_page(self):
+        image = binarization.binarization_exec(testImage, default_parameters())
+        expected = array(image)>127
+        sizes = {}
+        for output_format in ['png', 'png1', 'tiffg4', 'packbits']:
+            binarization.args['output_format'] = output_format
+            output = io.BytesIO()
+            binarization.save_output(image, output)
+            sizes[output_format] = len(output.getvalue())
+            output.seek(0)
+            result = ocrolib.read_image_binary(output)
+            self.assertTrue((result==expected).all())
+        logger.info("output sizes %s" % sizes)
+        self.assertLess(sizes['png1'], sizes['png'])
+        self.assertLess(sizes['tiffg4'], sizes['png1'])
+
+    def test_constant_pages_decode_alike(self):
+        for value in [0, 1]:
+            page = value*ones((40, 30), bool)
+            encodings = {'packbits': ocrolib.pack_binary(page)}
+            for output_format, mode in [('png', 'L'), ('png1', '1')]:
+                output = io.BytesIO()
+                PIL.Image.fromarray(array(255*page, 'B')).convert(mode).save(output, 'PNG')
+                encodings[output_format] = output.getvalue()
+            for output_format, data in encodings.items():
+                result = ocrolib.read_image_binary(io.BytesIO(data))
+                self.assertEqual(result.shape, page.shape)
+                # a constant page has no foreground in every format
+                self.assertFalse(result.any(), output_format)
+
+
+class FlatCacheTest(TestCase):
+
+    def setUp(self):
+        self.flat_cache = binarization.flat_cache
+
+    def tearDown(self):
+        binarization.flat_cache = self.flat_cache
+
+    def test_cached_rebinarization_matches_uncached(self):
+        changes = [dict(threshold=0.6), dict(lo=10, hi=95), dict(escale=0.5)]
+        binarization.flat_cache = binarization.FlatCache(0)
+        expected = [array(binarization.binarization_exec(testImage, default_parameters(**kw))) for kw in changes]
+        binarization.flat_cache = binarization.FlatCache(1<<30)
+        binarization.binarization_exec(testImage, default_parameters())
+        for kw, page in zip(changes, expected):
+            begin = time.time()
+            result = array(binarization.binarization_exec(testImage, default_parameters(**kw)))
+            logger.info("cached re-binarization with %s: %.2fs" % (kw, time.time()-begin))
+            self.assertTrue((page==result).all())
+        self.assertEqual(len(binarization.flat_cache.entries), 1)
+
+    def test_lru_eviction_by_bytes(self):
+        cache = binarization.FlatCache(3000)
+        entry = lambda: dict(flat=zeros(100), angle=0, masks={})
+        for key in 'abc':
+            cache.put(key, entry())
+        cache.get('a')
+        cache.put('d', entry())
+        self.assertEqual(list(cache.entries), ['c', 'a', 'd'])
+        cache.put('e', dict(flat=zeros(1000), angle=0, masks={}))
+        self.assertNotIn('e', cache.entries)
+        self.assertEqual(cache.nbytes, 2400)
+
+    def test_cached_entries_are_not_modified(self):
+        cache = binarization.FlatCache(3000)
+        cache.put('a', dict(flat=zeros(100), angle=0, masks={}))
+        entry = cache.get('a')
+        other = cache.add_mask('a', entry, (1.0, 'full'), ones(400, bool))
+        self.assertEqual(entry['masks'], {})
+        self.assertIs(cache.get('a'), other)
+        # a mask computed from the older entry keeps the one added meanwhile
+        other = cache.add_mask('a', entry, (0.5, 'full'), None)
+        self.assertEqual(sorted(other['masks']), [(0.5, 'full'), (1.0, 'full')])
+        self.assertEqual(cache.nbytes, 1200)
+        self.assertEqual(binarization.FlatCache(0).add_mask(None, entry, (0, 'full'), None)['masks'], {(0, 'full'): None})
+
+    def test_bytes_of_entries_with_several_masks(self):
+        binarization.flat_cache = binarization.FlatCache(1<<30)
+        for escale, maskmethod in [(1.0, 'full'), (0.5, 'full'), (0.5, 'decimated'), (0, 'full')]:
+            binarization.binarization_exec(testImage, default_parameters(escale=escale, maskmethod=maskmethod))
+        cache = binarization.flat_cache
+        entry, = cache.entries.values()
+        self.assertEqual(len(entry['masks']), 4)
+        self.assertEqual(cache.nbytes, sum(cache.size(e) for e in cache.entries.values()))
+        # a budget for the flat page and one of its masks
+        cache = binarization.flat_cache = binarization.FlatCache(entry['flat'].nbytes*9//8)
+        for escale in [1.0, 0.5, 0]:
+            binarization.binarization_exec(testImage, default_parameters(escale=escale))
+            self.assertEqual(cache.nbytes, sum(cache.size(e) for e in cache.entries.values()))
+            self.assertLessEqual(cache.nbytes, cache.maxbytes)
+
+
+class SweepTest(TestCase):
+
+    def test_sweep_archive_matches_single_requests(self):
+        flat_cache = binarization.flat_cache
+        binarization.flat_cache = binarization.FlatCache(0)
+        try:
+            with open(testImage, 'rb') as f:
+                image = SimpleUploadedFile('page.jpg', f.read())
+            begin = time.time()
+            response = self.client.post('/binarizationapi/sweep', {'image': image, 'thresholds': '0.4,0.5,0.6', 'percentiles': '5:90,10:95'})
+            logger.info("sweep of 6 binarizations: %.2fs" % (time.time()-begin))
+            self.assertEqual(response.status_code, 200)
+            archive = zipfile.ZipFile(io.BytesIO(response.content))
+            self.assertEqual(len(archive.namelist()), 6)
+            for lo, hi, threshold in [(5, 90, 0.4), (10, 95, 0.6)]:
+                expected = binarization.binarization_exec(testImage, default_parameters(lo=lo, hi=hi, threshold=threshold))
+                result = PIL.Image.open(io.BytesIO(archive.read('page_lo%g_hi%g_t%g_bin.png' % (lo, hi, threshold))))
+                self.assertTrue((array(expected)==array(result)).all())
+        finally:
+            binarization.flat_cache = flat_cache
+
+    def test_invalid_sweep(self):
+        with open(testImage, 'rb') as f:
+            image = SimpleUploadedFile('page.jpg', f.read())
+        response = self.client.post('/binarizationapi/sweep', {'image': image, 'percentiles': '5:90:95'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MaskMethodTest(TestCase):
+
+    def test_decimated_mask_thresholds_within_tolerance(self):
+        rotated = tempfile.mktemp(suffix='.png')
+        PIL.Image.open(testImage).convert('L').rotate(1.3, resample=PIL.Image.BICUBIC, fillcolor=255).save(rotated)
+        try:
+            for path in [testImage, rotated]:
+                for escale in [0.5, 1.0]:
+                    binarization.args = default_parameters(escale=escale, nocheck=True)
+                    flat, angle = binarization.flatten_page(path)
+                    thresholds = {}
+                    for maskmethod in ['full', 'decimated']:
+                        binarization.args['maskmethod'] = maskmethod
+                        est = binarization.threshold_region(flat)[binarization.threshold_mask(flat)]
+                        thresholds[maskmethod] = [stats.scoreatpercentile(est, per) for per in [5, 90]]
+                    (lo, hi), decimated = thresholds['full'], thresholds['decimated']
+                    logger.info("escale %g lo-hi full (%.4f %.4f) decimated (%.4f %.4f)" % (escale, lo, hi, decimated[0], decimated[1]))
+                    self.assertLessEqual(amax(abs(array(decimated)-[lo, hi])), 0.01*(hi-lo))
+        finally:
+            os.remove(rotated)
+
+
+class StageTimingTest(TestCase):
+
+    def test_stage_timing_header_and_metrics(self):
+        flat_cache = binarization.flat_cache
+        binarization.flat_cache = binarization.FlatCache(0)
+        try:
+            with open(testImage, 'rb') as f:
+                response = self.client.post('/binarizationapi/', {'image': SimpleUploadedFile('page.jpg', f.read())})
+        finally:
+            binarization.flat_cache = flat_cache
+        self.assertEqual(response.status_code, 200)
+        stages = ['decode', 'normalize', 'flatten', 'skew', 'thresholds', 'rescale', 'encode']
+        timing = [span.split(';dur=') for span in response['Server-Timing'].split(', ')]
+        logger.info("Server-Timing: %s" % response['Server-Timing'])
+        self.assertEqual([name for name, _ in timing], stages)
+        self.assertTrue(all(float(dur)>=0 for _, dur in timing))
+        self.assertEqual([span.split('=')[0] for span in response['X-Stage-RSS-Delta'].split(', ')], stages)
+        metrics = self.client.get('/binarizationapi/metrics').json()
+        for stage in stages:
+            self.assertGreaterEqual(metrics[stage]['count'], 1)
+            self.assertGreaterEqual(metrics[stage]['max'], metrics[stage]['mean'])
+
+    def test_timer_of_each_thread(self):
+        binarization.timer.start()
+        with binarization.timer.span('decode'):
+            pass
+        def request():
+            binarization.timer.start()
+            with binarization.timer.span('flatten'):
+                pass
+            return list(binarization.timer.spans)
+        thread = ThreadPool(1)
+        try:
+            self.assertEqual(thread.apply(request), ['flatten'])
+        finally:
+            thread.terminate()
+        self.assertEqual(list(binarization.timer.spans), ['decode'])
+
+    def test_same_stages_in_every_path(self):
+        stages = ['decode', 'normalize', 'flatten', 'skew', 'thresholds', 'rescale']
+        binarization.binarization_exec(testImage, default_parameters(maxmem=100))
+        self.assertEqual(list(binarization.timer.spans), stages)
+        binarization.binarization_exec(testImage, default_parameters(algorithm='sauvola'))
+        self.assertEqual(list(binarization.timer.spans), ['decode', 'normalize', 'skew', 'thresholds', 'rescale'])
+
+
+class LumaDecodeTest(TestCase):
+
+    def test_luma_decoding(self):
+        color = tempfile.mktemp(suffix='.jpg')
+        page = PIL.Image.open(testImage)
+        PIL.ImageOps.colorize(page, (40,30,20), (250,240,210)).save(color, quality=90)
+        try:
+            image, half = ocrolib.read_image_luma(color, dtype='f', half=1)
+            self.assertEqual(image.dtype, dtype('f'))
+            self.assertEqual(half.shape, ((page.size[1]+1)//2, (page.size[0]+1)//2))
+            # the luma of the decoded colors, up to the rounding of the JPEG decoders
+            gray = array(PIL.Image.open(color).convert('L'))/255.0
+            self.assertLess(mean(abs(image-gray)), 2/255.0)
+            expected = array(binarization.binarization_exec(color, default_parameters()))
+            result = array(binarization.binarization_exec(color, default_parameters(decode='luma')))
+            self.assertLess(sum(expected!=result), 0.005*expected.size)
+        finally:
+            os.remove(color)
+
+
+class MultiPageTest(TestCase):
+
+    def test_batch_of_tiff_pages(self):
+        page = PIL.Image.open(testImage).convert('L')
+        rotated = page.rotate(1.3, resample=PIL.Image.BICUBIC, fillcolor=255)
+        volume = io.BytesIO()
+        page.save(volume, 'TIFF', save_all=True, append_images=[rotated, page])
+        self.assertEqual(ocrolib.number_of_pages(volume), 3)
+        self.assertTrue((ocrolib.read_image_gray((volume, 1))==array(rotated)/255.0).all())
+        response = self.client.post('/binarizationapi/batch', {'image': SimpleUploadedFile('volume.tif', volume.getvalue())})
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(sorted(archive.namelist()), ['volume_0001_bin.png', 'volume_0002_bin.png', 'volume_0003_bin.png'])
+        rotated_path = tempfile.mktemp(suffix='.png')
+        rotated.save(rotated_path)
+        try:
+            expected = binarization.binarization_exec(rotated_path, default_parameters())
+        finally:
+            os.remove(rotated_path)
+        result = PIL.Image.open(io.BytesIO(archive.read('volume_0002_bin.png')))
+        self.assertTrue((array(expected)==array(result)).all())
+
+
+class LocalThresholdTest(TestCase):
+
+    def test_matches_windows_of_pixels(self):
+        image = array(filters.gaussian_filter(random.RandomState(0).rand(70,50),1),'f')
+        image = (image-amin(image))/(amax(image)-amin(image))
+        r = 7
+        for algorithm, k in [('sauvola',0.2), ('niblack',0.2), ('niblack',-0.3)]:
+            expected = zeros(image.shape)
+            for i in range(image.shape[0]):
+                for j in range(image.shape[1]):
+                    window = image[max(0,i-r):i+r+1,max(0,j-r):j+r+1].astype('d')
+                    m, s = mean(window), std(window)
+                    expected[i,j] = m*(1+k*(s/0.5-1)) if algorithm=='sauvola' else m-k*s
+            result = binarization.local_threshold(image,2*r+1,k,algorithm)
+            # up to float32 rounding of the thresholds
+            near = abs(image-expected)<1e-5
+            self.assertTrue(((result==(image>expected))|near).all())
+            self.assertTrue((binarization.local_threshold(image,2*r+1,k,algorithm,rows=16)==result).all())
+
+    def test_sauvola_service(self):
+        whole = binarization.binarization_exec(testImage, default_parameters(algorithm='sauvola'))
+        self.assertIn('thresholds', binarization.timer.spans)
+        self.assertNotIn('flatten', binarization.timer.spans)
+        tiled = binarization.binarization_exec(testImage, default_parameters(algorithm='sauvola', maxmem=8))
+        self.assertTrue((array(whole)==array(tiled)).all())
+        # mostly the same text pixels as nlbin
+        nlbin = array(binarization.binarization_exec(testImage, default_parameters()))
+        self.assertLess(abs(mean(array(whole)==0)-mean(nlbin==0)), 0.02)
+        with open(testImage, 'rb') as f:
+            response = self.client.post('/binarizationapi/sweep', {'image': f, 'algorithm': 'sauvola', 'thresholds': '0.4,0.5'})
+        self.assertEqual(response.status_code, 400)
@@ -4,6 +4,9 @@ from api import views
 
 urlpatterns = [
     url(r'^$', views.binarizationView, name='binarizationView'),
+    url(r'^batch$', views.batchView, name='batchView'),
+    url(r'^sweep$', views.sweepView, name='sweepView'),
+    url(r'^metrics$', views.metricsView, name='metricsView'),
 ]
 
 urlpatterns = format_suffix_patterns(urlpatterns)
@@ -25,17 +25,20 @@ from rest_framework.decorators import api_view, parser_classes
 from rest_framework.response import Response
 from rest_framework import status
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.shortcuts import render
 from wsgiref.util import FileWrapper
 from .models import Parameters
-from .binarization import binarization_exec
+from . import binarization
+from .binarization import binarization_exec, binarization_job, binarization_sweep, save_output, output_formats
 from .extrafunc import resize_image, del_service_files
 from .serializers import ParameterSerializer
 import sys, os, os.path
 import time
 import logging
+import zipfile, StringIO, tempfile
+import ocrolib
 
 # Set encoding
 reload(sys)
@@ -86,8 +89,15 @@ def binarizationView(request, format=None):
         return Response("ERROR: sth wrong with binarization", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     ### Return image object (in memory)
-    response = HttpResponse(content_type="image/png")
-    output_file.save(response, "PNG")
+    content_type, extension = output_formats[paras_serializer.data['output_format']]
+    response = HttpResponse(content_type=content_type)
+    response['Content-Disposition'] = 'inline; filename=%s_bin.%s' % (os.path.splitext(str(image_object))[0], extension)
+    save_output(output_file, response)
+
+    ### Report the time of each stage
+    response['Server-Timing'] = binarization.timer.server_timing()
+    response['X-Stage-RSS-Delta'] = binarization.timer.rss_delta()
+    binarization.timer.record()
 
     ### Delete parameters object in DB
     Parameters.objects.filter(id=paras_serializer.data['id']).delete()
@@ -101,6 +111,193 @@ def binarizationView(request, format=None):
     return response
 
 
+class ZipStream(object):
+    """Write-only file object collecting the bytes written by zipfile, so
+    that the archive can be sent to the client entry by entry."""
+    def __init__(self):
+        self.data = []
+        self.position = 0
+    def write(self, data):
+        self.data.append(data)
+        self.position += len(data)
+    def tell(self):
+        return self.position
+    def flush(self):
+        pass
+    def pop(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+def batch_workers():
+    return settings.BATCH_WORKERS or ocrolib.number_of_processors()
+
+def number_of_pages(image):
+    try:
+        return ocrolib.number_of_pages(image)
+    except Exception:
+        return 1
+
+def batch_jobs(images, parameters):
+    """The jobs of binarization_job() for the uploaded images, and the paths
+    of the temporary files holding the multi-page ones. Each page of a
+    multi-page image (e.g. a TIFF volume) is a job of its own, named
+    {imagename}_{page}, which reads only that page from the file."""
+    jobs, paths = [], []
+    for image in images:
+        name = str(image)
+        pages = number_of_pages(image)
+        if pages == 1:
+            image.seek(0)
+            jobs.append((len(jobs), name, image.read(), parameters))
+            continue
+        base, ext = os.path.splitext(name)
+        fd, path = tempfile.mkstemp(suffix=ext)
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in image.chunks():
+                f.write(chunk)
+        paths.append(path)
+        for pageno in range(pages):
+            jobs.append((len(jobs), "%s_%04d%s" % (base, pageno+1, ext), (path, pageno), parameters))
+    return jobs, paths
+
+def stream_batch(jobs, extension, receive_req, paths=()):
+    """Binarize the jobs on the persistent worker pool and yield the zip
+    archive of the outputs, one entry as soon as each page is finished.
+    The temporary files in `paths` are deleted at the end."""
+    logger = logging.getLogger('django')
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    try:
+        for index, name, data, spans in ocrolib.parallel_map(binarization_job, jobs, parallel=batch_workers(), persistent=1):
+            timer = ocrolib.StageTimer()
+            timer.spans = spans
+            timer.record()
+            base = os.path.splitext(os.path.basename(name))[0]
+            if data is None:
+                logger.error("sth wrong with binarization of image %s" % name)
+                archive.writestr("%s_error.txt" % base, b"ERROR: sth wrong with binarization")
+            else:
+                archive.writestr("%s_bin.%s" % (base, extension), data)
+            logger.info("*** Batch image %d (%s): %.2fs ***" % (index, name, time.time()-receive_req))
+            yield stream.pop()
+        archive.close()
+        logger.info("*** Batch service time: %.2fs ***" % (time.time()-receive_req))
+        yield stream.pop()
+    finally:
+        for path in paths:
+            os.remove(path)
+
+### Batch version: binarize all the images (or pages of multi-page images) of the request on a persistent worker pool => stream a zip of the outputs
+@csrf_exempt
+@api_view(['GET', 'POST'])
+def batchView(request, format=None):
+    receive_req = time.time()
+    logger = logging.getLogger('django')
+    images = request.FILES.getlist('image')
+    if len(images) < 1:
+        logger.error("Please upload at least one image")
+        return Response("ERROR: Please upload at least one image", status=status.HTTP_400_BAD_REQUEST)
+
+    ### Receive parameters with model serializer
+    paras_serializer = ParameterSerializer(data=request.data)
+    if paras_serializer.is_valid():
+        paras_serializer.save()
+    else:
+        logger.error(paras_serializer.errors)
+        return Response(paras_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    parameters = dict(paras_serializer.data)
+
+    ### Delete parameters object in DB, the pages are processed while the response is sent
+    Parameters.objects.filter(id=paras_serializer.data['id']).delete()
+
+    jobs, paths = batch_jobs(images, parameters)
+    content_type, extension = output_formats[parameters['output_format']]
+    response = StreamingHttpResponse(stream_batch(jobs, extension, receive_req, paths), content_type="application/x-zip-compressed")
+    response['Content-Disposition'] = 'attachment; filename=binarization.zip'
+    return response
+
+
+def parse_sweep(request):
+    """The thresholds and (lo, hi) percentile pairs of a sweep request, e.g.
+    thresholds=0.3,0.5,0.7 and percentiles=5:90,10:95, or None if invalid."""
+    try:
+        thresholds = [float(t) for t in request.data.get('thresholds', '').split(',') if t.strip()]
+        percentiles = [tuple(float(p) for p in pair.split(':')) for pair in request.data.get('percentiles', '').split(',') if pair.strip()]
+    except ValueError:
+        return None
+    if any(len(pair) != 2 for pair in percentiles):
+        return None
+    return thresholds, percentiles
+
+### Sweep version: flatten the image once => binarize it with several thresholds and percentiles => response a zip of the outputs
+@csrf_exempt
+@api_view(['GET', 'POST'])
+def sweepView(request, format=None):
+    receive_req = time.time()
+    logger = logging.getLogger('django')
+    if request.data.get('image') is None:
+        logger.error("Please upload only one image")
+        return Response("ERROR: Please upload only one image", status=status.HTTP_400_BAD_REQUEST)
+    sweep = parse_sweep(request)
+    if sweep is None:
+        logger.error("Invalid thresholds or percentiles")
+        return Response("ERROR: thresholds must be like 0.3,0.5 and percentiles like 5:90,10:95", status=status.HTTP_400_BAD_REQUEST)
+
+    ### Receive parameters with model serializer
+    paras_serializer = ParameterSerializer(data=request.data)
+    if paras_serializer.is_valid():
+        paras_serializer.save()
+    else:
+        logger.error(paras_serializer.errors)
+        return Response(paras_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    parameters = paras_serializer.data
+    Parameters.objects.filter(id=parameters['id']).delete()
+    if parameters['algorithm'] != 'nlbin':
+        logger.error("Sweep of algorithm %s" % parameters['algorithm'])
+        return Response("ERROR: thresholds and percentiles only apply to algorithm nlbin", status=status.HTTP_400_BAD_REQUEST)
+
+    ### Without a list, the single value of the parameters is used
+    thresholds, percentiles = sweep
+    thresholds = thresholds or [parameters['threshold']]
+    percentiles = percentiles or [(parameters['lo'], parameters['hi'])]
+
+    image_object = request.FILES['image']
+    bin_begin = time.time()
+    outputs = binarization_sweep(image_object, parameters, thresholds, percentiles)
+    bin_end = time.time()
+    if outputs is None:
+        logger.error("sth wrong with binarization")
+        return Response("ERROR: sth wrong with binarization", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    ### Zip the output images in memory
+    content_type, extension = output_formats[parameters['output_format']]
+    imagename_base = os.path.splitext(str(image_object))[0]
+    zip_io = StringIO.StringIO()
+    with zipfile.ZipFile(zip_io, 'w', zipfile.ZIP_STORED) as archive:
+        for (lo, hi, threshold), output_file in outputs:
+            output = StringIO.StringIO()
+            save_output(output_file, output)
+            archive.writestr("%s_lo%g_hi%g_t%g_bin.%s" % (imagename_base, lo, hi, threshold, extension), output.getvalue())
+    response = HttpResponse(zip_io.getvalue(), content_type="application/x-zip-compressed")
+    response['Content-Disposition'] = 'attachment; filename=%s_sweep.zip' % imagename_base
+    response['Server-Timing'] = binarization.timer.server_timing()
+    response['X-Stage-RSS-Delta'] = binarization.timer.rss_delta()
+    binarization.timer.record()
+
+    send_resp = time.time()
+    logger.info("===== Image %s sweep (%d outputs) =====" % (str(image_object), len(outputs)))
+    logger.info("*** Bin: %.2fs ***" % (bin_end-bin_begin))
+    logger.info("*** Service time: %.2fs ***" % (send_resp-receive_req))
+    return response
+
+
+### Time of each stage of binarization, aggregated over the requests served by this process
+@api_view(['GET'])
+def metricsView(request, format=None):
+    return Response(ocrolib.stage_statistics())
+
+
 """
 ### Old version: save image to disk => process image from disk => save output to disk => response output image => delete disk images
 @csrf_exempt
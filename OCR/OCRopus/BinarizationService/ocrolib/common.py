@@ -22,7 +22,7 @@ from numpy import (amax, amin, array, bitwise_and, clip, dtype, mean, minimum,
                    nan, sin, sqrt, zeros)
 import pylab
 from pylab import (clf, cm, ginput, gray, imshow, ion, subplot, where)
-from scipy.ndimage import morphology, measurements
+from scipy.ndimage import morphology, measurements, interpolation
 import PIL
 
 from default import getlocal
@@ -34,6 +34,10 @@ import ligatures
 import lstm
 import morph
 import multiprocessing
+import threading
+import contextlib
+import collections
+import time
 import sl
 import StringIO
 
@@ -153,34 +157,78 @@ def isintarray(a):
 def isintegerarray(a):
     return a.dtype in [dtype('int32'),dtype('int64'),dtype('uint32'),dtype('uint64')]
 
+def open_image(fname,pageno=0):
+    """PIL.Image.open() of page `pageno` of an image file with several
+    pages (e.g. a multi-page TIFF).  The file is given by name, as a file
+    object (read from its start), or as a (fname,pageno) tuple.  Pages
+    are located lazily, without decoding the previous ones."""
+    if type(fname)==tuple: fname,pageno = fname
+    if hasattr(fname,"seek"): fname.seek(0)
+    pil = PIL.Image.open(fname)
+    if pageno>0: pil.seek(pageno)
+    return pil
+
+def number_of_pages(fname):
+    """The number of pages of an image file (1 for most formats)."""
+    return getattr(open_image(fname),"n_frames",1)
+
 #@checks(str,pageno=int,_=GRAYSCALE) (Annoted by Jingchao Luan)
-def read_image_gray(fname,pageno=0):
+def read_image_gray(fname,pageno=0,dtype='d'):
     """Read an image and returns it as a floating point array.
     The optional page number allows images from files containing multiple
     images to be addressed.  Byte and short arrays are rescaled to
-    the range 0...1 (unsigned) or -1...1 (signed)."""
+    the range 0...1 (unsigned) or -1...1 (signed), directly in the
+    floating point `dtype` (e.g. 'f' for float32)."""
 
-    if type(fname)==tuple: fname,pageno = fname
-    assert pageno==0
-    pil = PIL.Image.open(fname)
+    pil = open_image(fname,pageno)
     a = pil2array(pil)
-    if a.dtype==dtype('uint8'):
-        a = a/255.0
-    if a.dtype==dtype('int8'):
-        a = a/127.0
-    elif a.dtype==dtype('uint16'):
-        a = a/65536.0
-    elif a.dtype==dtype('int16'):
-        a = a/32767.0
+    if a.dtype==numpy.dtype('uint8'):
+        a = numpy.divide(a,255.0,dtype=dtype)
+    if a.dtype==numpy.dtype('int8'):
+        a = numpy.divide(a,127.0,dtype=dtype)
+    elif a.dtype==numpy.dtype('uint16'):
+        a = numpy.divide(a,65536.0,dtype=dtype)
+    elif a.dtype==numpy.dtype('int16'):
+        a = numpy.divide(a,32767.0,dtype=dtype)
     elif isfloatarray(a):
-        pass
+        a = array(a,dtype,copy=0)
     else:
         raise OcropusException("unknown image type: "+a.dtype)
     if a.ndim==3:
-        a = mean(a,2)
+        a = mean(a,2,dtype=dtype)
     return a
 
 
+def pil_luma(pil):
+    """Returns the PIL image in "L" mode (ITU-R 601-2 luma for color
+    images).  JPEG images are decoded straight to grayscale with PIL's
+    draft mode, which skips the color conversion of the decoder."""
+    if pil.format=="JPEG" and pil.mode!="L":
+        pil.draft("L",pil.size)
+    if pil.mode!="L":
+        pil = pil.convert("L")
+    return pil
+
+def read_image_luma(fname,dtype='d',half=0,pageno=0):
+    """Read an image as its luma and returns it as a floating point array
+    of the given `dtype` in the range 0...1, without any full resolution
+    color or float64 temporary (see pil_luma()).  With `half`, this returns
+    a pair of the image and the image shrunk by 2 (sizes rounded up) with
+    PIL's box filter.  Images that are not 8 bits per channel are read
+    with read_image_gray()."""
+    if type(fname)==tuple: fname,pageno = fname
+    pil = open_image(fname,pageno)
+    if pil.mode not in ("1","L","LA","P","RGB","RGBA","CMYK","YCbCr"):
+        a = read_image_gray(fname,pageno,dtype=dtype)
+        if not half: return a
+        return a,interpolation.zoom(a,0.5)
+    pil = pil_luma(pil)
+    a = numpy.divide(pil2array(pil),255.0,dtype=dtype)
+    if not half: return a
+    w,h = pil.size
+    small = pil.resize(((w+1)//2,(h+1)//2),PIL.Image.BOX)
+    return a,numpy.divide(pil2array(small),255.0,dtype=dtype)
+
 def write_image_gray(fname,image,normalize=0,verbose=0):
     """Write an image to disk.  If the image is of floating point
     type, its values are clipped to the range [0,1],
@@ -193,27 +241,72 @@ def write_image_gray(fname,image,normalize=0,verbose=0):
     im = array2pil(image)
     im.save(fname)
 
-@checks(str,_=ABINARY2)
+# header of the packed binary format written by pack_binary()
+packed_binary_magic = b"OCROPACK"
+
+def pack_binary(image):
+    """Encode a binary image as a packed_binary_magic header, the height and
+    width as little-endian uint32, and the rows of numpy.packbits(), each
+    padded to whole bytes.  Pixels that are nonzero are stored as 1."""
+    assert image.ndim==2
+    h,w = image.shape
+    header = packed_binary_magic+numpy.array([h,w],'<u4').tostring()
+    return header+numpy.packbits(image!=0,axis=1).tostring()
+
+def unpack_binary(data):
+    """Decode the output of pack_binary() to a boolean array."""
+    n = len(packed_binary_magic)
+    assert data[:n]==packed_binary_magic,"not a packed binary image"
+    h,w = numpy.frombuffer(data[n:n+8],'<u4')
+    bits = numpy.frombuffer(data[n+8:],'B').reshape(h,(w+7)//8)
+    return numpy.unpackbits(bits,axis=1)[:,:w]!=0
+
+def binary2pil(image):
+    """Convert a binary image to a bilevel ("1" mode) PIL image, built from
+    the packed bits.  Pixels that are nonzero become white."""
+    assert image.ndim==2
+    h,w = image.shape
+    return PIL.Image.frombytes("1",(w,h),numpy.packbits(image!=0,axis=1).tostring())
+
+#@checks(str,_=ABINARY2)
 def read_image_binary(fname,dtype='i',pageno=0):
     """Read an image from disk and return it as a binary image
-    of the given dtype."""
+    of the given dtype.  Besides the usual image formats, this reads
+    bilevel images (e.g. 1-bit PNG or G4 TIFF) without going through
+    8 bit grayscale, and the packed format of pack_binary().  `fname`
+    may also be a file object, and `pageno` selects a page of a multi-page
+    image (see open_image()).  All the formats are thresholded at the
+    midrange of the image, so a constant page is all 0."""
     if type(fname)==tuple: fname,pageno = fname
-    assert pageno==0
-    pil = PIL.Image.open(fname)
-    a = pil2array(pil)
-    if a.ndim==3: a = amax(a,axis=2)
-    return array(a>0.5*(amin(a)+amax(a)),dtype)
+    stream = fname if hasattr(fname,"read") else open(fname,"rb")
+    stream.seek(0)
+    if stream.read(len(packed_binary_magic))==packed_binary_magic:
+        assert pageno==0
+        stream.seek(0)
+        a = unpack_binary(stream.read()).view('B')
+    else:
+        pil = open_image(stream,pageno)
+        if pil.mode=="1":
+            w,h = pil.size
+            bits = numpy.frombuffer(pil.tobytes(),'B').reshape(h,(w+7)//8)
+            a = numpy.unpackbits(bits,axis=1)[:,:w]
+        else:
+            a = pil2array(pil)
+        if a.ndim==3: a = amax(a,axis=2)
+    # the midrange in floating point, since amin(a)+amax(a) overflows uint8
+    return array(a>0.5*(float(amin(a))+float(amax(a))),dtype)
 
-@checks(str,ABINARY2)
-def write_image_binary(fname,image,verbose=0):
+#@checks(str,ABINARY2)
+def write_image_binary(fname,image,verbose=0,format=None):
     """Write a binary image to disk. This verifies first that the given image
     is, in fact, binary.  The image may be of any type, but must consist of only
-    two values."""
+    two values.  `fname` may also be a file object, written in the PIL
+    `format`."""
     if verbose: print("# writing", fname)
     assert image.ndim==2
     image = array(255*(image>midrange(image)),'B')
     im = array2pil(image)
-    im.save(fname)
+    im.save(fname,format=format)
 
 @checks(AINT3,_=AINT2)
 def rgb2int(a):
@@ -489,11 +582,30 @@ def number_of_processors():
     return multiprocessing.cpu_count()
     # return int(os.popen("cat /proc/cpuinfo  | grep 'processor.*:' | wc -l").read())
 
-def parallel_map(fun,jobs,parallel=0,chunksize=1):
+persistent_pools = {}
+persistent_pools_lock = threading.Lock()
+
+def persistent_pool(parallel):
+    """Returns a multiprocessing.Pool with the given number of workers.
+    The pool is created on first use and shared by all later calls, so
+    that servers do not pay for starting the workers on every request."""
+    with persistent_pools_lock:
+        if parallel not in persistent_pools:
+            persistent_pools[parallel] = multiprocessing.Pool(parallel)
+        return persistent_pools[parallel]
+
+def parallel_map(fun,jobs,parallel=0,chunksize=1,persistent=0):
+    """Maps fun over jobs, yielding the results as they finish when
+    running in parallel.  With `persistent`, the jobs run on the shared
+    persistent_pool() instead of a pool created for this call."""
     if parallel<2:
         for e in jobs:
             result = fun(e)
             yield result
+    elif persistent:
+        pool = persistent_pool(parallel)
+        for e in pool.imap_unordered(fun,jobs,chunksize):
+            yield e
     else:
         try:
             pool = multiprocessing.Pool(parallel)
@@ -504,6 +616,68 @@ def parallel_map(fun,jobs,parallel=0,chunksize=1):
             pool.join()
             del pool
 
+################################################################
+### timing of processing stages
+################################################################
+
+def resident_bytes():
+    """Resident memory of this process in bytes, or 0 where
+    /proc/self/statm is not available."""
+    try:
+        with open("/proc/self/statm") as stream:
+            return int(stream.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (IOError,ValueError,OSError):
+        return 0
+
+stage_totals = {}
+stage_totals_lock = threading.Lock()
+
+class StageTimer:
+    """Records the wall time and the change of resident memory (RSS delta)
+    of named spans of a computation:
+
+        timer = StageTimer()
+        with timer.span("flatten"):
+            ...
+
+    Both are cheap to measure (a clock and a /proc read per span).  The
+    RSS delta is not the bytes the span allocates: memory freed or reused
+    within the span makes it smaller, zero or negative.
+    Spans with the same name are added up.  record() adds the spans to
+    the totals of the process, which are reported by stage_statistics()."""
+    def __init__(self):
+        self.spans = collections.OrderedDict()
+    @contextlib.contextmanager
+    def span(self,name):
+        start,memory = time.time(),resident_bytes()
+        try:
+            yield
+        finally:
+            t,m = self.spans.get(name,(0.0,0))
+            self.spans[name] = (t+time.time()-start,m+resident_bytes()-memory)
+    def server_timing(self):
+        """The spans as the value of a Server-Timing header (ms)."""
+        return ", ".join("%s;dur=%.1f"%(name,1000*t) for name,(t,_) in self.spans.items())
+    def rss_delta(self):
+        """The change of resident memory of each span, as name=bytes."""
+        return ", ".join("%s=%d"%(name,m) for name,(_,m) in self.spans.items())
+    def record(self):
+        with stage_totals_lock:
+            for name,(t,m) in self.spans.items():
+                total = stage_totals.setdefault(name,[0,0.0,0.0,0])
+                total[0] += 1
+                total[1] += t
+                total[2] = max(total[2],t)
+                total[3] += m
+
+def stage_statistics():
+    """For each stage recorded by StageTimer.record() in this process, the
+    number of spans, their total, mean and maximum time (s), and the mean
+    change of resident memory (bytes)."""
+    with stage_totals_lock:
+        return dict((name,dict(count=n,total=t,mean=t/n,max=tmax,rss_delta=m/n))
+                    for name,(n,t,tmax,m) in stage_totals.items())
+
 def check_valid_class_label(s):
     """Determines whether the given character is a valid class label.
     Control characters and spaces are not permitted."""
@@ -890,14 +1064,40 @@ def midrange(image,frac=0.5):
     (for quick thresholding)."""
     return frac*(amin(image)+amax(image))
 
-def remove_noise(line,minsize=8):
-    """Remove small pixels from an image."""
+def percentiles(a,pers,mask=None,overwrite=0):
+    """Computes several percentiles of the values of an array (of those
+    where `mask` is true, if given), with the same linear interpolation as
+    scipy.stats.scoreatpercentile(), in linear time: the order statistics
+    around all the percentiles are selected by one numpy.partition()
+    instead of a sort.  With `overwrite`, a flat array `a` is partitioned
+    in place instead of a copy."""
+    a = a[mask] if mask is not None else numpy.ravel(a)
+    n = len(a)
+    assert n>0,"no values"
+    weights = []
+    for per in pers:
+        idx = per/100.*(n-1)
+        i = int(idx)
+        if i==idx: weights.append(([i],array([1.0])))
+        else: weights.append(([i,i+1],array([i+1-idx,idx-i])))
+    kth = sorted(set(sum([r for r,_ in weights],[])))
+    if overwrite or mask is not None:
+        a.partition(kth)
+    else:
+        a = numpy.partition(a,kth)
+    return [numpy.add.reduce(a[r]*w)/w.sum() for r,w in weights]
+
+def remove_noise(line,minsize=8,stats=None):
+    """Remove small pixels from an image.  `stats` are the
+    morph.ComponentStats of the foreground of line, if already
+    computed."""
     if minsize==0: return line
     bin = (line>0.5*amax(line))
-    labels,n = morph.label(bin)
-    sums = measurements.sum(bin,labels,range(n+1))
-    sums = sums[labels]
-    good = minimum(bin,1-(sums>0)*(sums<minsize))
+    if stats is None: stats = morph.ComponentStats(bin)
+    small = zeros(stats.n+1,bool)
+    small[1:] = (stats.counts<minsize)
+    good = array(bin,'B')
+    good[small[stats.labels]] = 0
     return good
 
 class MovingStats:
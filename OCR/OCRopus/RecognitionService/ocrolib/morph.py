@@ -10,6 +10,7 @@ from pylab import *
 from scipy.ndimage import morphology,measurements,filters
 from scipy.ndimage.morphology import *
 from toplevel import *
+import sl
 
 @checks(ABINARY2)
 def label(image,**kw):
@@ -26,6 +27,24 @@ def label(image,**kw):
     # let it raise the same exception as before
     return measurements.label(image,**kw)
 
+@checks(ABINARY2)
+def small_label(image):
+    """Like label(), with the smallest type for the labels of a page:
+    uint16 when there are less than 65536 components, int32 otherwise."""
+    try: return measurements.label(image,output=uint16)
+    except RuntimeError: pass
+    labels,n = label(image)
+    return asarray(labels,'i'),n
+
+def label_counts(labels,n,pixels=1<<20):
+    """The number of pixels of each label 0..n, counted in strips of
+    about `pixels` pixels (bincount works on an intp copy of the labels)."""
+    counts = zeros(n+1,int)
+    step = max(1,pixels//max(1,labels.shape[1]))
+    for y in range(0,labels.shape[0],step):
+        counts += bincount(labels[y:y+step].ravel(),minlength=n+1)
+    return counts
+
 @checks(AINT2)
 def find_objects(image,**kw):
     """Redefine the scipy.ndimage.measurements.find_objects function to
@@ -41,6 +60,105 @@ def find_objects(image,**kw):
     # let it raise the same exception as before
     return measurements.find_objects(image,**kw)
     
+class ComponentStats:
+    """The connected components of a binary image, labeled once, with
+    their bounding boxes and pixel counts as arrays indexed by label-1
+    (y0, y1, x0, x1, height, width, area of the box and counts of the
+    pixels).  `objects` are the slices of find_objects().  The
+    functions working on the same page share one of these instead of
+    labeling the page again."""
+    def __init__(self,binary,labels=None,objects=None):
+        if labels is None:
+            labels,_ = small_label(binary)
+            objects = find_objects(labels)
+        self.labels = labels
+        self.objects = objects
+        self.n = len(objects)
+        bounds = array([sl.raster(o) for o in objects],int).reshape(self.n,4)
+        self.y0,self.y1,self.x0,self.x1 = bounds.T
+        self.height = self.y1-self.y0
+        self.width = self.x1-self.x0
+        self.area = self.height*self.width
+        self.counts = label_counts(labels,self.n)[1:]
+    def keep(self,selected):
+        """The statistics of the image with only the selected components
+        (a boolean array over the labels), renumbered in order, without
+        labeling it again."""
+        selected = asarray(selected,bool)
+        renumber = zeros(self.n+1,self.labels.dtype)
+        renumber[1:][selected] = arange(1,sum(selected)+1)
+        objects = [o for o,s in zip(self.objects,selected) if s]
+        return ComponentStats(None,renumber[self.labels],objects)
+    def update(self,binary):
+        """These statistics if binary has the same pixels as the labeled
+        image, otherwise the statistics of binary."""
+        if binary.shape==self.labels.shape and ((binary!=0)==(self.labels!=0)).all():
+            return self
+        return ComponentStats(binary)
+    def scores(self,f):
+        """The scores f(o) of the objects, from the arrays for the
+        functions of ocrolib.sl that have one."""
+        if f in (sl.dim0,sl.height): return self.height
+        if f in (sl.dim1,sl.width): return self.width
+        if f is sl.area: return self.area
+        return array([f(o) for o in self.objects])
+
+### Rectangular erosion and dilation of binary images on packed bits.
+### The rows are packed 64 pixels to a word and each axis is filtered with
+### the van Herk/Gil-Werman algorithm (cumulative ORs or ANDs forward and
+### backward within blocks of the size of the element), so the cost per
+### pixel does not depend on the size of the element.  The r_* and rb_*
+### functions use this for images of 0/1 with origin 0, where it gives the
+### same results as the scipy filters, unless rect_backend is "scipy".
+
+rect_backend = "packed"
+
+def packed_rows(image):
+    """The rows of a binary image (nonzero pixels are 1) packed into
+    uint64 words."""
+    bits = packbits(image,axis=1)
+    words = zeros((image.shape[0],-(-bits.shape[1]//8)*8),'B')
+    words[:,:bits.shape[1]] = bits
+    return words.view('u8')
+
+def unpacked_rows(words,w):
+    """The binary image of w columns of packed_rows()."""
+    return unpackbits(words.view('B'),axis=1)[:,:w]
+
+def van_herk(words,size,op,fill):
+    """op (bitwise_or or bitwise_and) of the rows within a window of size
+    rows, centered like the scipy filters, with fill outside the image."""
+    n = len(words)
+    left = size//2
+    blocks = -(-(n+size-1)//size)
+    padded = empty((blocks*size,words.shape[1]),words.dtype)
+    padded[:] = fill
+    padded[left:left+n] = words
+    padded = padded.reshape(blocks,size,-1)
+    forward = op.accumulate(padded,axis=1).reshape(blocks*size,-1)
+    backward = op.accumulate(padded[:,::-1],axis=1)[:,::-1].reshape(blocks*size,-1)
+    return op(backward[:n],forward[size-1:size-1+n])
+
+def packed_rectangle(image,size,op,fill):
+    """The van_herk() of the rows and then of the columns of the image."""
+    h,w = image.shape
+    size0,size1 = [int(s) for s in size]
+    if size0<=1 and size1<=1: return array(image!=0,'B')
+    result = image
+    if size0>1:
+        result = unpacked_rows(van_herk(packed_rows(result),size0,op,fill),w)
+    if size1>1:
+        columns = ascontiguousarray(result.T)
+        columns = unpacked_rows(van_herk(packed_rows(columns),size1,op,fill),h)
+        result = ascontiguousarray(columns.T)
+    return result
+
+def use_packed(image,size,origin):
+    """Whether the packed bits give the results of the scipy filters."""
+    if rect_backend!="packed" or image.size==0 or any(asarray(origin)!=0): return 0
+    if any(array(size,int)<1): return 0
+    return image.dtype==dtype(bool) or amax(image)<=1
+
 def check_binary(image):
     assert image.dtype=='B' or image.dtype=='i' or image.dtype==dtype('bool'),\
         "array should be binary, is %s %s"%(image.dtype,image.shape)
@@ -50,11 +168,15 @@ def check_binary(image):
 @checks(ABINARY2,uintpair)
 def r_dilation(image,size,origin=0):
     """Dilation with rectangular structuring element using maximum_filter"""
+    if use_packed(image,size,origin):
+        return asarray(packed_rectangle(image,size,bitwise_or,0),image.dtype)
     return filters.maximum_filter(image,size,origin=origin)
 
 @checks(ABINARY2,uintpair)
 def r_erosion(image,size,origin=0):
     """Erosion with rectangular structuring element using maximum_filter"""
+    if use_packed(image,size,origin):
+        return asarray(packed_rectangle(image,size,bitwise_and,~uint64(0)),image.dtype)
     return filters.minimum_filter(image,size,origin=origin)
 
 @checks(ABINARY2,uintpair)
@@ -74,16 +196,20 @@ def r_closing(image,size,origin=0):
 @checks(ABINARY2,uintpair)
 def rb_dilation(image,size,origin=0):
     """Binary dilation using linear filters."""
+    if use_packed(image,size,origin):
+        return packed_rectangle(image,size,bitwise_or,0)
     output = zeros(image.shape,'f')
     filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=0)
-    return array(output>0,'i')
+    return array(output>0,'B')
 
 @checks(ABINARY2,uintpair)
 def rb_erosion(image,size,origin=0):
     """Binary erosion using linear filters."""
+    if use_packed(image,size,origin):
+        return packed_rectangle(image,size,bitwise_and,~uint64(0))
     output = zeros(image.shape,'f')
     filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=1)
-    return array(output==1,'i')
+    return array(output==1,'B')
 
 @checks(ABINARY2,uintpair)
 def rb_opening(image,size,origin=0):
@@ -124,12 +250,18 @@ def showlabels(x,n=7):
     pylab.imshow(where(x>0,x%n+1,0),cmap=pylab.cm.gist_stern)
 
 @checks(SEGMENTATION)
-def spread_labels(labels,maxdist=9999999):
-    """Spread the given labels to the background"""
-    distances,features = morphology.distance_transform_edt(labels==0,return_distances=1,return_indices=1)
-    indexes = features[0]*labels.shape[1]+features[1]
-    spread = labels.ravel()[indexes.ravel()].reshape(*labels.shape)
-    spread *= (distances<maxdist)
+def spread_labels(labels,maxdist=9999999,rows=256):
+    """Spread the given labels to the background.  The distances to the
+    nearest labels are computed from the feature transform, `rows` rows
+    at a time, instead of as a floating point image."""
+    features = morphology.distance_transform_edt(labels==0,return_distances=0,return_indices=1)
+    spread = zeros(labels.shape,labels.dtype)
+    x = arange(labels.shape[1])
+    for y0 in range(0,labels.shape[0],rows):
+        fy,fx = features[0][y0:y0+rows],features[1][y0:y0+rows]
+        y = arange(y0,y0+len(fy)).reshape(-1,1)
+        distances = sqrt((fy-y)**2.0+(fx-x)**2.0)
+        spread[y0:y0+rows] = labels[fy,fx]*(distances<maxdist)
     return spread
 
 @checks(ABINARY2,ABINARY2)
@@ -176,14 +308,16 @@ def propagate_labels(image,labels,conflict=0):
     """Given an image and a set of labels, apply the labels
     to all the regions in the image that overlap a label.
     Assign the value `conflict` to any labels that have a conflict."""
-    rlabels,_ = label(image)
-    cors = correspondences(rlabels,labels)
-    outputs = zeros(amax(rlabels)+1,'i')
-    oops = -(1<<30)
-    for o,i in cors.T:
-        if outputs[o]!=0: outputs[o] = oops
-        else: outputs[o] = i
-    outputs[outputs==oops] = conflict
+    rlabels,_ = small_label(image)
+    # the (region,label) pairs of the labeled pixels
+    labeled = (labels!=0)
+    q = int(amax(labels))+1
+    cors = unique(array(rlabels[labeled],int)*q+labels[labeled])
+    o,i = cors//q,cors%q
+    outputs = zeros(amax(rlabels)+1,promote_types(labels.dtype,min_scalar_type(conflict)))
+    # regions overlapping more than one label are conflicts
+    outputs[o] = i
+    outputs[bincount(o,minlength=len(outputs))>1] = conflict
     outputs[0] = 0
     return outputs[rlabels]
 
@@ -192,19 +326,14 @@ def select_regions(binary,f,min=0,nbest=100000):
     """Given a scoring function f over slice tuples (as returned by
     find_objects), keeps at most nbest regions whose scores is higher
     than min."""
-    labels,n = label(binary)
-    objects = find_objects(labels)
-    scores = [f(o) for o in objects]
+    stats = ComponentStats(binary)
+    scores = stats.scores(f)
     best = argsort(scores)
-    keep = zeros(len(objects)+1,'i')
+    keep = zeros(stats.n+1,'B')
     if nbest > 0:
-        for i in best[-nbest:]:
-            if scores[i]<=min: continue
-            keep[i+1] = 1
-    # print scores,best[-nbest:],keep
-    # print sorted(list(set(labels.ravel())))
-    # print sorted(list(set(keep[labels].ravel())))
-    return keep[labels]
+        best = best[-nbest:]
+        keep[best[scores[best]>min]+1] = 1
+    return keep[stats.labels]
 
 @checks(SEGMENTATION)
 def all_neighbors(image):
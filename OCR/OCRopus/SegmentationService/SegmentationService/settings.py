@@ -32,7 +32,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
-import os
+import os, tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -186,4 +186,8 @@ BINARIZATION_SERIVICE_BASE_URL = "http://segmentationservice.acis.ufl.edu"
 # Absolute filesystem path to the directory that will hold user-uploaded files.
 MEDIA_ROOT = os.path.join(BASE_DIR, 'data')
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a trailing slash.
-MEDIA_URL = '/data/'
\ No newline at end of file
+MEDIA_URL = '/data/'
+# Directory of the cache of segmentations, shared by the server processes using it, and
+# the bytes of its files (None or 0: no cache).
+SEGMENTATION_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'segmentation_cache')
+SEGMENTATION_CACHE_BYTES = 256*1024*1024
@@ -23,5 +23,7 @@ class Parameters(models.Model):
 	sepwiden = models.IntegerField(default=10, help_text="widen black separators (to account for warping)")
 	maxcolseps = models.IntegerField(default=3, help_text="maximum # whitespace column separators")
 	csminheight = models.FloatField(default=10.0, help_text="minimum column height (units=scale)")
+	multires = models.BooleanField(default=False, help_text="find the whitespace column separators and the gradient maps on a page reduced to a scale of about 8 pixels")
+	output = models.CharField(max_length=10, default="lines", choices=(("lines", "lines"), ("geometry", "geometry")), help_text="output: zip of the line images, or JSON of the line bounds and run length encoded masks")
 
 	#parallel = models.IntegerField(default=0, help_text="number of parallel CPUs to use")
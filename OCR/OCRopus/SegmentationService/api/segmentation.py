@@ -34,12 +34,14 @@
 from __future__ import print_function
 
 from pylab import *
-import glob,os,os.path
-import traceback
+import glob,os,os.path,StringIO
+import traceback,hashlib,tempfile
+import numpy
 from scipy.ndimage import measurements
 from scipy.misc import imsave
 from scipy.ndimage.filters import gaussian_filter,uniform_filter,maximum_filter
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import ocrolib
 from ocrolib import psegutils,morph,sl
 from ocrolib.exceptions import OcropusException
@@ -54,6 +56,9 @@ args_default = {
     # output parameters
     'pad':3,         # adding for extracted lines
     'expand':3,      # expand mask for grayscale extraction
+    'threads':1,     # threads extracting the lines ahead of their encoding
+    # multi-resolution parameters
+    'multiscale':8.0,  # scale of the reduced page with multires
     # other parameters
     'nocheck':True,  # disable error checking on inputs
     'quiet':False,   # be less verbose
@@ -65,8 +70,10 @@ args = {}
 logger = logging.getLogger('django')
 
 # The entry of segmentation service
-# Return the directories, each directory related to a input image and stored the segmented line images  
-def segmentation_exec(image, parameters):
+# Return a generator of the (name, PNG data) of the segmented line images, extracted as they are read,
+# or the page_geometry() of the lines with output=geometry
+# For the pages (file, pageno) of a multi-page image, digest is the file_digest() of the file
+def segmentation_exec(image, parameters, digest=None):
     # Update parameters values customed by user
     # Each time update the args with the default args dictionary, avoid the effect of the previous update
     global args
@@ -86,7 +93,7 @@ def segmentation_exec(image, parameters):
     # Segment the image
     output_list = []
     try:
-        output_list = process(image)
+        output_list = process(image, digest)
     except OcropusException as e:
         if e.trace:
             traceback.print_exc()
@@ -182,13 +189,14 @@ def compute_colseps_conv(binary,scale=1.0):
     thresholding."""
     h,w = binary.shape
     # find vertical whitespace by thresholding
-    smoothed = gaussian_filter(1.0*binary,(scale,scale*0.5))
-    smoothed = uniform_filter(smoothed,(5.0*scale,1))
+    smoothed = gaussian_filter(binary,(scale,scale*0.5),output='d')
+    smoothed = uniform_filter(smoothed,(5.0*scale,1),output=smoothed)
     thresh = (smoothed<amax(smoothed)*0.1)
+    del smoothed
     DSAVE("1thresh",thresh)
     # find column edges by filtering
-    grad = gaussian_filter(1.0*binary,(scale,scale*0.5),order=(0,1))
-    grad = uniform_filter(grad,(10.0*scale,1))
+    grad = gaussian_filter(binary,(scale,scale*0.5),order=(0,1),output='d')
+    grad = uniform_filter(grad,(10.0*scale,1),output=grad)
     # grad = abs(grad) # use this for finding both edges
     grad = (grad>0.5*amax(grad))
     DSAVE("2grad",grad)
@@ -201,15 +209,46 @@ def compute_colseps_conv(binary,scale=1.0):
     DSAVE("4seps",seps)
     return seps
 
+def multires_factor(scale):
+    """The decimation factor of the page for the whitespace separators
+    and the gradient maps with multires: the page is reduced to a scale
+    of about args['multiscale'] pixels."""
+    if not args['multires']: return 1
+    return max(1,int(scale/args['multiscale']))
+
+def decimate(image,fy,fx):
+    """The mean of the image over blocks of fy by fx pixels, the blocks
+    at the bottom and right edges being padded with 0."""
+    h,w = image.shape
+    padded = zeros((-(-h//fy)*fy,-(-w//fx)*fx),'f')
+    padded[:h,:w] = image
+    return padded.reshape(padded.shape[0]//fy,fy,padded.shape[1]//fx,fx).mean(axis=3).mean(axis=1)
+
+def upsample(image,fy,fx,shape):
+    """Repeats the pixels of a decimate()d image back to the shape."""
+    return image.repeat(fy,axis=0).repeat(fx,axis=1)[:shape[0],:shape[1]]
+
 def compute_colseps(binary,scale):
     """Computes column separators either from vertical black lines or whitespace."""
     logger.info("considering at most %g whitespace column separators" % args['maxcolseps'])
-    colseps = compute_colseps_conv(binary,scale)
-    DSAVE("colwsseps",0.7*colseps+0.3*binary)
+    # the filters are several scales wide, so the separators can be found
+    # on a reduced page and repeated back to the full resolution
+    f = multires_factor(scale)
+    if f>1:
+        colseps = compute_colseps_conv(decimate(binary,f,f),scale/f)
+        colseps = upsample(colseps,f,f,binary.shape)
+    else:
+        colseps = compute_colseps_conv(binary,scale)
+    # the blended images would be computed even when not debugging
+    if args['debug']: DSAVE("colwsseps",0.7*colseps+0.3*binary)
     
     logger.info("considering at most %g black column separators" % args['maxseps'])
-    seps = compute_separators_morph(binary,scale)
-    DSAVE("colseps",0.7*seps+0.3*binary)
+    if args['maxseps']>0:
+        seps = compute_separators_morph(binary,scale)
+    else:
+        # select_regions() keeps none of them
+        seps = zeros(binary.shape,'B')
+    if args['debug']: DSAVE("colseps",0.7*seps+0.3*binary)
     colseps = maximum(colseps,seps)
     binary = minimum(binary,1-seps)
     return colseps,binary
@@ -224,24 +263,69 @@ def compute_colseps(binary,scale):
 ### Those components are then used as seeds for the text lines.
 ################################################################
 
-def compute_gradmaps(binary,scale):
+def compute_gradmaps(binary,scale,stats=None):
     # use gradient filtering to find baselines
-    boxmap = psegutils.compute_boxmap(binary,scale)
+    boxmap = psegutils.compute_boxmap(binary,scale,stats=stats)
     cleaned = boxmap*binary
     DSAVE("cleaned",cleaned)
+    # the filters are only several scales wide horizontally, so the columns
+    # can be reduced with multires, but the rows keep the baselines
+    f = multires_factor(scale)
+    if f>1: cleaned = decimate(cleaned,1,f)
     if args['usegause']:
         # this uses Gaussians
-        grad = gaussian_filter(1.0*cleaned,(args['vscale']*0.3*scale,
-                                            args['hscale']*6*scale),order=(1,0))
+        grad = gaussian_filter(cleaned,(args['vscale']*0.3*scale,
+                                        args['hscale']*6*scale/f),order=(1,0),output='d')
     else:
         # this uses non-Gaussian oriented filters
-        grad = gaussian_filter(1.0*cleaned,(max(4,args['vscale']*0.3*scale),
-                                            args['hscale']*scale),order=(1,0))
-        grad = uniform_filter(grad,(args['vscale'],args['hscale']*6*scale))
-    bottom = ocrolib.norm_max((grad<0)*(-grad))
-    top = ocrolib.norm_max((grad>0)*grad)
+        grad = gaussian_filter(cleaned,(max(4,args['vscale']*0.3*scale),
+                                        args['hscale']*scale/f),order=(1,0),output='d')
+        grad = uniform_filter(grad,(args['vscale'],args['hscale']*6*scale/f),output=grad)
+    del cleaned
+    if f>1: grad = upsample(grad,1,f,binary.shape)
+    # the negative and positive parts of the gradient, normalized in place
+    bottom = negative(grad)
+    maximum(bottom,0,out=bottom)
+    bottom /= amax(bottom)
+    top = maximum(grad,0,out=grad)
+    top /= amax(top)
     return bottom,top,boxmap
 
+def seed_runs(bmarked,tmarked,delta,maxgap):
+    """Marks, in each column, the delta pixels above each baseline
+    candidate (bmarked), and the pixels from the candidate up to the
+    next xheight candidate (tmarked) or the top of the page, when that
+    is less than maxgap above it.
+
+    All the columns are processed at once: the candidates are sorted by
+    (column,row,bottom), each bottom candidate is paired with the
+    candidate before it, and the runs are drawn with a cumulative sum
+    of their +1/-1 ends down each column."""
+    h,w = bmarked.shape
+    ty,tx = nonzero(tmarked)
+    by,bx = nonzero(bmarked)
+    events = concatenate([2*(tx*h+ty),2*(bx*h+by)+1])
+    events.sort()
+    x,y,bottom = events//(2*h),(events//2)%h,events%2
+    first = ones(len(events),bool)
+    first[1:] = (x[1:]!=x[:-1])
+    # the candidate above each bottom candidate, or a top one at row 0
+    above = flatnonzero(bottom)
+    x0,y0 = x[above],y[above]
+    y1 = where(first[above],0,y[above-1])
+    top1 = first[above]|(bottom[above-1]==0)
+    # the rows of the bottom candidates of a column are distinct, and so
+    # are the candidates above them, so no index repeats within one +=
+    ends = zeros((w,h+1),'i')
+    runs = (y0>=delta)
+    ends[x0[runs],y0[runs]-delta] += 1
+    ends[x0[runs],y0[runs]] -= 1
+    runs = top1&(y0-y1<maxgap)
+    ends[x0[runs],y1[runs]] += 1
+    ends[x0[runs],y0[runs]] -= 1
+    seeds = cumsum(ends,axis=1,out=ends)[:,:h]>0
+    return array(transpose(seeds),'B')
+
 def compute_line_seeds(binary,bottom,top,colseps,scale):
     """Base on gradient maps, computes candidates for baselines
     and xheights.  Then, it marks the regions between the two
@@ -249,25 +333,16 @@ def compute_line_seeds(binary,bottom,top,colseps,scale):
     t = args['threshold']
     vrange = int(args['vscale']*scale)
     bmarked = maximum_filter(bottom==maximum_filter(bottom,(vrange,0)),(2,2))
-    bmarked = bmarked*(bottom>t*amax(bottom)*t)*(1-colseps)
+    bmarked &= (bottom>t*amax(bottom)*t)&(colseps==0)
     tmarked = maximum_filter(top==maximum_filter(top,(vrange,0)),(2,2))
-    tmarked = tmarked*(top>t*amax(top)*t/2)*(1-colseps)
+    tmarked &= (top>t*amax(top)*t/2)&(colseps==0)
     tmarked = maximum_filter(tmarked,(1,20))
-    seeds = zeros(binary.shape,'i')
     delta = max(3,int(scale/2))
-    for x in range(bmarked.shape[1]):
-        transitions = sorted([(y,1) for y in find(bmarked[:,x])]+[(y,0) for y in find(tmarked[:,x])])[::-1]
-        transitions += [(0,0)]
-        for l in range(len(transitions)-1):
-            y0,s0 = transitions[l]
-            if s0==0: continue
-            seeds[y0-delta:y0,x] = 1
-            y1,s1 = transitions[l+1]
-            if s1==0 and (y0-y1)<5*scale: seeds[y1:y0,x] = 1
+    seeds = seed_runs(bmarked,tmarked,delta,5*scale)
     seeds = maximum_filter(seeds,(1,int(1+scale)))
     seeds = seeds*(1-colseps)
-    DSAVE("lineseeds",[seeds,0.3*tmarked+0.7*bmarked,binary])
-    seeds,_ = morph.label(seeds)
+    if args['debug']: DSAVE("lineseeds",[seeds,0.3*tmarked+0.7*bmarked,binary])
+    seeds,_ = morph.small_label(seeds)
     return seeds
 
 
@@ -276,32 +351,35 @@ def compute_line_seeds(binary,bottom,top,colseps,scale):
 ### The complete line segmentation process.
 ################################################################
 
-def remove_hlines(binary,scale,maxsize=10):
-    labels,_ = morph.label(binary)
-    objects = morph.find_objects(labels)
-    for i,b in enumerate(objects):
-        if sl.width(b)>maxsize*scale:
-            labels[b][labels[b]==i+1] = 0
-    return array(labels!=0,'B')
+def remove_hlines(binary,scale,maxsize=10,stats=None):
+    """Removes the components wider than maxsize*scale.  Returns the
+    binary image and its morph.ComponentStats."""
+    if stats is None: stats = morph.ComponentStats(binary)
+    stats = stats.keep(stats.width<=maxsize*scale)
+    return array(stats.labels!=0,'B'),stats
 
-def compute_segmentation(binary,scale):
+def compute_segmentation(binary,scale,stats=None):
     """Given a binary image, compute a complete segmentation into
-    lines, computing both columns and text lines."""
+    lines, computing both columns and text lines.  `stats` are the
+    morph.ComponentStats of binary, if already computed."""
     binary = array(binary,'B')
 
     # start by removing horizontal black lines, which only
     # interfere with the rest of the page segmentation
-    binary = remove_hlines(binary,scale)
+    binary,stats = remove_hlines(binary,scale,stats=stats)
 
     # do the column finding
     if not args['quiet']: logger.info("computing column separators")
     colseps,binary = compute_colseps(binary,scale)
+    # black separators cut through the components they cross
+    stats = stats.update(binary)
 
     # now compute the text line seeds
     if not args['quiet']: logger.info("computing lines")
-    bottom,top,boxmap = compute_gradmaps(binary,scale)
+    bottom,top,boxmap = compute_gradmaps(binary,scale,stats=stats)
     seeds = compute_line_seeds(binary,bottom,top,colseps,scale)
     DSAVE("seeds",[bottom,top,boxmap])
+    del bottom,top,colseps
 
     # spread the text line seeds to all the remaining
     # components
@@ -315,19 +393,149 @@ def compute_segmentation(binary,scale):
 
 
 
+################################################################
+### Cache of segmentations.
+###
+### Segmenting a page again with the same parameters reuses the lines
+### of the previous request, found by the SHA-256 of the image and the
+### parameters that affect the segmentation.  The cache is a directory
+### of files, so it is shared by the processes of the server.
+################################################################
+
+# parameters that change the segmentation (the others only change its output);
+# nocheck decides whether check_page() may reject the page
+segmentation_parameters = ['minscale','maxlines','scale','hscale','vscale','threshold','usegause',
+                           'maxseps','sepwiden','maxcolseps','csminheight','multires','multiscale',
+                           'nocheck']
+
+# version of the cache entries, to be increased whenever the segmentation
+# or the format of the entries changes, so that older entries are not used
+segmentation_cache_version = 1
+
+class SegmentationCache:
+    """Least recently used cache of segmentations on disk, limited by the
+    number of bytes of its files.  An entry is a compressed .npz file
+    holding the `segmentation` as the numbers of the lines in reading
+    order (the renumbered segmentation less 0x010000, 0 outside of the
+    lines), the `bounds` (y0,y1,x0,x1) of the lines and the `scale`.
+    Entries are written to a temporary file and renamed, reading one
+    touches it, and the least recently touched are evicted."""
+    def __init__(self,directory,maxbytes):
+        self.directory = directory
+        self.maxbytes = maxbytes
+    def enabled(self):
+        return self.directory is not None and self.maxbytes>0
+    def path(self,key):
+        return os.path.join(self.directory,key+".npz")
+    def get(self,key):
+        """The (shape,scale,lines) of an entry, or None."""
+        try:
+            with open(self.path(key),'rb') as stream:
+                entry = numpy.load(stream)
+                numbers,bounds,scale = entry['segmentation'],entry['bounds'],float(entry['scale'])
+            os.utime(self.path(key),None)
+        except (IOError,OSError,KeyError,ValueError):
+            # missing, or evicted by another process
+            return None
+        lines = []
+        for i,(y0,y1,x0,x1) in enumerate(bounds):
+            o = (slice(y0,y1),slice(x0,x1))
+            lines.append(psegutils.record(label=0x010000+(i+1),bounds=o,mask=(numbers[o]==i+1)))
+        return numbers.shape,scale,lines
+    def put(self,key,segmentation,scale,lines):
+        """Writes an entry for the renumbered segmentation and its lines in
+        reading order, and evicts the least recently used entries beyond
+        maxbytes."""
+        numbers = where(segmentation>0,segmentation-0x010000,0)
+        numbers = array(numbers,'uint16' if len(lines)<65536 else 'i')
+        bounds = array([sl.raster(l.bounds) for l in lines],'i').reshape(-1,4)
+        try: os.makedirs(self.directory)
+        except OSError: pass
+        fd,temp = tempfile.mkstemp(suffix=".tmp",dir=self.directory)
+        with os.fdopen(fd,'wb') as stream:
+            numpy.savez_compressed(stream,segmentation=numbers,bounds=bounds,scale=scale)
+        os.rename(temp,self.path(key))
+        self.evict()
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"): continue
+            path = os.path.join(self.directory,name)
+            try: info = os.stat(path)
+            except OSError: continue
+            entries.append((info.st_mtime,info.st_size,path))
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if total<=self.maxbytes: break
+            try: os.remove(path)
+            except OSError: pass
+            total -= size
+
+segmentation_cache = SegmentationCache(getattr(settings,'SEGMENTATION_CACHE_DIR',None),
+                                       getattr(settings,'SEGMENTATION_CACHE_BYTES',0))
+
+def image_digest(image,digest=None):
+    """SHA-256 of the bytes of an image file, given by path or file object,
+    and of the page number for a page (file, pageno) of a multi-page image.
+    The digest of the file can be given for the pages, so that it is
+    computed once per request rather than once per page."""
+    if type(image)==tuple:
+        if digest is None: digest = image_digest(image[0])
+        return hashlib.sha256("%s:%d" % (digest,image[1])).hexdigest()
+    digest = hashlib.sha256()
+    stream = image if hasattr(image,'read') else open(image,'rb')
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1<<20),b''):
+        digest.update(chunk)
+    stream.seek(0)
+    if stream is not image: stream.close()
+    return digest.hexdigest()
+
+def segmentation_cache_key(image,digest=None):
+    values = [float(args[k]) for k in segmentation_parameters]
+    return hashlib.sha256("%d:%s:%r" % (segmentation_cache_version,image_digest(image,digest),values)).hexdigest()
+
+def file_digest(image):
+    """The image_digest() of a multi-page file, for the segmentation_exec()
+    of each of its pages, or None if the cache is disabled or the file
+    cannot be read."""
+    if not segmentation_cache.enabled(): return None
+    try:
+        return image_digest(image)
+    except IOError:
+        return None
+
+
+
 ################################################################
 ### Processing each file.
 ################################################################
 
-def process(image):
-    imagename_base, ext = os.path.splitext(str(image))
-    outputdir = os.path.join(dataDir, imagename_base)
+def process(image,digest=None):
+    if type(image)==tuple:
+        # page (file, pageno) of a multi-page image
+        imagename_base = "%s_%04d" % (os.path.splitext(str(image[0]))[0], image[1]+1)
+    else:
+        imagename_base, ext = os.path.splitext(str(image))
+
+    try:
+        key = segmentation_cache_key(image,digest) if segmentation_cache.enabled() else None
+    except IOError:
+        key = None
+    cached = segmentation_cache.get(key) if key is not None else None
+    if cached is not None:
+        logger.info("%s: segmentation found in cache" % (image,))
+        shape,scale,lines = cached
+        if args['output']=='geometry':
+            return page_geometry(shape,scale,lines)
+        binary = 1-ocrolib.read_image_binary(image,'B')
+        return page_lines(image,imagename_base,binary,None,scale,lines)
 
     try:
-        binary = ocrolib.read_image_binary(image)
+        binary = ocrolib.read_image_binary(image,'B')
     except IOError:
         if ocrolib.trace: traceback.print_exc()
-        logger.error("cannot open %s" % (image))
+        logger.error("cannot open %s" % (image,))
         return
 
     checktype(binary,ABINARY2)
@@ -340,8 +548,10 @@ def process(image):
 
     binary = 1-binary # invert
 
+    # the components of the page, shared by the steps below
+    stats = morph.ComponentStats(binary)
     if args['scale']==0:
-        scale = psegutils.estimate_scale(binary)
+        scale = psegutils.estimate_scale(binary,stats=stats)
     else:
         scale = args['scale']
     logger.info("scale %f" % (scale))
@@ -354,7 +564,7 @@ def process(image):
 
     # find columns and text lines
     if not args['quiet']: logger.info("computing segmentation")
-    segmentation = compute_segmentation(binary,scale)
+    segmentation = compute_segmentation(binary,scale,stats=stats)
     if amax(segmentation)>args['maxlines']:
         logger.error("%s: too many lines %g" % (image, amax(segmentation)))
         return
@@ -373,37 +583,77 @@ def process(image):
     segmentation = renumber[segmentation]
 
     # finally, output everything
-    if not args['quiet']: logger.info("writing lines")
-    if not os.path.exists(outputdir):
-        os.mkdir(outputdir)
+    if len(lines)==0:
+        logger.error("%s: no lines" % (image,))
+        return
     lines = [lines[i] for i in lsort]
     #ocrolib.write_page_segmentation("%s.pseg.png"%outputdir,segmentation)
-    cleaned = ocrolib.remove_noise(binary,args['noise'])
-
-    ### Return image files list (in disk)
-    # write into output list
-    output_list = []
-    outputpath_base = os.path.join(outputdir,imagename_base)
-    for i,l in enumerate(lines):
-        binline = psegutils.extract_masked(1-cleaned,l,pad=args['pad'],expand=args['expand'])
-        output_line = outputpath_base + "_%d.png" % (i+1)
-        ocrolib.write_image_binary(output_line, binline)
-        output_list.append(output_line)
-    logger.info("%6d  %s %4.1f %d" % (i, image,  scale,  len(lines)))
-    return output_list
-    """
-
-    ### Return image objects dictionary (in memory)
-    output_dic = {}  # key: line NO. value: single-line image object
-    for index, line in enumerate(lines):
-        binline = psegutils.extract_masked(1-cleaned,line,pad=args['pad'],expand=args['expand'])
-        assert binline.ndim==2
-        midrange = 0.5*(amin(binline)+amax(binline))
-        image_array = array(255*(binline>midrange),'B')
-        image_pil = ocrolib.array2pil(image_array)
-        output_dic[index] = image_pil
-    logger.info("%6d  %s %4.1f %d" % (i, image,  scale,  len(lines)))
-    print("=== dic ===")
-    print(output_dic)
-    return output_dic
-    """
+    if key is not None: segmentation_cache.put(key,segmentation,scale,lines)
+    if args['output']=='geometry':
+        return page_geometry(binary.shape,scale,lines)
+    return page_lines(image,imagename_base,binary,stats,scale,lines)
+
+def page_lines(image,imagename_base,binary,stats,scale,lines):
+    """The line_images() of the page, once the components smaller than
+    `noise` are removed.  `stats` are the morph.ComponentStats of binary,
+    if already computed."""
+    cleaned = ocrolib.remove_noise(binary,args['noise'],stats=stats)
+    logger.info("%s %4.1f %d" % (image, scale, len(lines)))
+
+    ### Return the line images as they are extracted (in memory)
+    return line_images(1-cleaned,lines,os.path.basename(imagename_base),args['pad'],args['expand'],args['threads'])
+
+def mask_runs(mask):
+    """Run length encoding of a binary mask in column-major order: the
+    lengths of the alternating runs of 0s and 1s, starting with 0s."""
+    mask = ravel(mask!=0,order='F')
+    ends = concatenate([[0],flatnonzero(mask[1:]!=mask[:-1])+1,[len(mask)]])
+    runs = diff(ends)
+    if len(mask)>0 and mask[0]: runs = concatenate([[0],runs])
+    return [int(r) for r in runs]
+
+def runs_string(runs):
+    """The compressed counts of COCO run length encoding (as pycocotools
+    rleToString): each run, minus the run two before it from the third
+    run on, in signed groups of 5 bits, as characters from '0'."""
+    chars = []
+    for i,x in enumerate(runs):
+        if i>2: x -= runs[i-2]
+        more = 1
+        while more:
+            c = x&0x1f
+            x >>= 5
+            more = x!=-1 if c&0x10 else x!=0
+            if more: c |= 0x20
+            chars.append(chr(c+48))
+    return str('').join(chars)
+
+def page_geometry(shape,scale,lines):
+    """The lines of the page in reading order, with their bounds (rows
+    y0:y1 and columns x0:x1 of the page) and their masks within the
+    bounds in COCO compressed run length encoding.  The line images are
+    the page within the bounds padded by `pad`, white outside of the
+    mask dilated by `expand`, once the components smaller than `noise`
+    are removed."""
+    geometry = dict(shape=[int(d) for d in shape],scale=float(scale),
+                    pad=args['pad'],expand=args['expand'],noise=args['noise'],lines=[])
+    for l in lines:
+        y0,y1,x0,x1 = [int(v) for v in sl.raster(l.bounds)]
+        mask = dict(size=[y1-y0,x1-x0],counts=runs_string(mask_runs(l.mask)))
+        geometry['lines'].append(dict(bounds=dict(y0=y0,y1=y1,x0=x0,x1=x1),mask=mask))
+    return geometry
+
+def line_images(page,lines,imagename_base,pad,expand,threads=1):
+    """Extracts the lines from the page in reading order, and yields the
+    name and the PNG data of each line as soon as it is encoded, without
+    writing to disk.  With several threads, the next lines are extracted
+    while a line is encoded."""
+    pool = ThreadPool(threads) if threads>1 else None
+    try:
+        binlines = psegutils.extract_lines(page,lines,pad=pad,expand=expand,pool=pool)
+        for i,binline in enumerate(binlines):
+            output = StringIO.StringIO()
+            ocrolib.write_image_binary(output,binline,format="PNG")
+            yield "%s_%d.png" % (imagename_base,i+1), output.getvalue()
+    finally:
+        if pool is not None: pool.terminate()
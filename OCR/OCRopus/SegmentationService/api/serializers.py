@@ -7,4 +7,4 @@ class ParameterSerializer(serializers.ModelSerializer):
 	class Meta:
 		model = Parameters
 		fields = ('id', 'minscale', 'maxlines', 'scale', 'hscale', 'vscale', 'threshold', 
-			'noise', 'usegause', 'maxseps', 'sepwiden', 'maxcolseps', 'csminheight')
+			'noise', 'usegause', 'maxseps', 'sepwiden', 'maxcolseps', 'csminheight', 'multires', 'output')
@@ -2,5 +2,543 @@
 from __future__ import unicode_literals
 
 from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from numpy import *
+import os, io, json, shutil, tempfile, zipfile
+from multiprocessing.pool import ThreadPool
+from scipy.ndimage import filters, measurements, morphology
+from scipy.ndimage.filters import maximum_filter
+import ocrolib
+from ocrolib import morph, psegutils, sl
+from api import segmentation
+from api.models import Parameters
+from api.serializers import ParameterSerializer
 
-# Create your tests here.
+testImage = os.path.join(settings.BASE_DIR, 'testimages', 'NY01075759_lg_bin.png')
+
+def setUpModule():
+    # the tests segment their pages, not the entries that earlier runs left
+    # in SEGMENTATION_CACHE_DIR; SegmentationCacheTest uses its own cache
+    global segmentation_cache
+    segmentation_cache = segmentation.segmentation_cache
+    segmentation.segmentation_cache = segmentation.SegmentationCache(None, 0)
+
+def tearDownModule():
+    segmentation.segmentation_cache = segmentation_cache
+
+
+class BinaryInputTest(TestCase):
+
+    def test_bilevel_encodings(self):
+        expected = ocrolib.read_image_binary(testImage)
+        encodings = [ocrolib.pack_binary(expected)]
+        for format, options in [("PNG", {}), ("TIFF", {'compression': "group4"})]:
+            output = io.BytesIO()
+            ocrolib.binary2pil(expected).save(output, format, **options)
+            encodings.append(output.getvalue())
+        for data in encodings:
+            result = ocrolib.read_image_binary(io.BytesIO(data))
+            self.assertEqual(result.dtype, expected.dtype)
+            self.assertTrue((result==expected).all())
+
+
+class MultiPageTest(TestCase):
+
+    def test_tiff_pages_are_segmented_one_by_one(self):
+        page = ocrolib.binary2pil(ocrolib.read_image_binary(testImage))
+        volume = io.BytesIO()
+        page.save(volume, 'TIFF', compression='group4', save_all=True, append_images=[page.rotate(90, expand=1), page])
+        self.assertEqual(ocrolib.number_of_pages(volume), 3)
+        self.assertEqual(ocrolib.read_image_binary((volume, 1)).shape, page.size)
+        with open(testImage, 'rb') as f:
+            response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('page.png', f.read())})
+        expected = sorted(zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist())
+        response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('volume.tif', volume.getvalue())})
+        self.assertEqual(response.status_code, 200)
+        names = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))).namelist()
+        for pageno in [1, 3]:
+            lines = sorted(name.replace('volume_%04d' % pageno, 'page') for name in names if '/volume_%04d/' % pageno in name)
+            self.assertEqual(lines, [name.replace('page_seg/', 'volume_seg/page/') for name in expected])
+        self.assertTrue(any('/volume_0002/' in name for name in names))
+
+
+class LineStreamingTest(TestCase):
+
+    def test_lines_are_streamed_from_memory(self):
+        before = os.listdir(settings.MEDIA_ROOT)
+        with open(testImage, 'rb') as f:
+            response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('page.png', f.read())})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        chunks = list(response.streaming_content)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+        names = archive.namelist()
+        # one chunk per line, and the end of the archive
+        self.assertEqual(len(chunks), len(names)+1)
+        self.assertEqual(names, ['page_seg/page_%d.png' % (i+1) for i in range(len(names))])
+        self.assertEqual(os.listdir(settings.MEDIA_ROOT), before)
+        for name in names:
+            line = ocrolib.read_image_binary(io.BytesIO(archive.read(name)))
+            self.assertTrue(line.shape[0] > 10 and amin(line) == 0 and amax(line) == 1)
+
+
+class SegmentationCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = segmentation.segmentation_cache
+        self.directory = tempfile.mkdtemp()
+        segmentation.segmentation_cache = segmentation.SegmentationCache(self.directory, 1<<30)
+
+    def tearDown(self):
+        segmentation.segmentation_cache = self.cache
+        shutil.rmtree(self.directory)
+
+    def post(self, **parameters):
+        with open(testImage, 'rb') as f:
+            parameters['image'] = SimpleUploadedFile('page.png', f.read())
+        response = self.client.post('/segmentationapi', parameters)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return b''.join(response.streaming_content)
+        return json.loads(response.content)
+
+    def test_repeated_requests_use_the_cache(self):
+        lines = self.post()
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        compute_segmentation = segmentation.compute_segmentation
+        segmentation.compute_segmentation = None
+        try:
+            self.assertEqual(self.post(), lines)
+            geometry = self.post(output='geometry')
+        finally:
+            segmentation.compute_segmentation = compute_segmentation
+        segmentation.segmentation_cache = segmentation.SegmentationCache(None, 0)
+        self.assertEqual(self.post(output='geometry'), geometry)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_parameters_are_part_of_the_key(self):
+        self.post(output='geometry')
+        self.post(output='geometry', noise=20)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        self.post(output='geometry', threshold=0.3)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_checks_and_version_are_part_of_the_key(self):
+        segmentation.args = segmentation.args_default.copy()
+        segmentation.args.update(ParameterSerializer(Parameters()).data)
+        key = segmentation.segmentation_cache_key(testImage)
+        segmentation.args['nocheck'] = False
+        self.assertNotEqual(segmentation.segmentation_cache_key(testImage), key)
+        segmentation.args['nocheck'] = True
+        version = segmentation.segmentation_cache_version
+        segmentation.segmentation_cache_version = version+1
+        try:
+            self.assertNotEqual(segmentation.segmentation_cache_key(testImage), key)
+        finally:
+            segmentation.segmentation_cache_version = version
+        self.assertEqual(segmentation.segmentation_cache_key(testImage), key)
+
+    def test_multi_page_file_is_hashed_once(self):
+        page = ocrolib.binary2pil(ocrolib.read_image_binary(testImage))
+        volume = io.BytesIO()
+        page.save(volume, 'TIFF', compression='group4', save_all=True, append_images=[page.rotate(90, expand=1), page])
+        image_digest = segmentation.image_digest
+        files = []
+        def counting_digest(image, digest=None):
+            if type(image) != tuple: files.append(image)
+            return image_digest(image, digest)
+        segmentation.image_digest = counting_digest
+        try:
+            response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('volume.tif', volume.getvalue()), 'output': 'geometry'})
+        finally:
+            segmentation.image_digest = image_digest
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['pages']), 3)
+        self.assertEqual(len(files), 1)
+        # the first and the last pages are alike, the second is rotated
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        digest = image_digest(volume)
+        self.assertEqual(segmentation.segmentation_cache_key((volume, 2), digest), segmentation.segmentation_cache_key((volume, 2)))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = segmentation.segmentation_cache
+        lines = [psegutils.record(bounds=(slice(1, 3), slice(2, 6)), mask=ones((2, 4), bool))]
+        page = zeros((10, 10), 'i')
+        page[1:3, 2:6] = 0x010001
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.put(key, page, 5.0, lines)
+            os.utime(cache.path(key), (i, i))
+        self.assertIsNotNone(cache.get('a'))
+        shape, scale, cached = cache.get('b')
+        self.assertEqual((shape, scale, cached[0].bounds), ((10, 10), 5.0, lines[0].bounds))
+        self.assertTrue((cached[0].mask == lines[0].mask).all())
+        cache.maxbytes = 2*os.path.getsize(cache.path('a'))
+        cache.evict()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['a.npz', 'b.npz'])
+
+
+class ExtractLinesTest(TestCase):
+
+    def test_same_lines_as_extract_masked(self):
+        state = random.RandomState(0)
+        for shape in [(60, 80), (7, 9)]:
+            page = array(state.rand(*shape) > 0.5, 'B')
+            for _ in range(50):
+                y0, x0 = state.randint(shape[0]), state.randint(shape[1])
+                y1, x1 = state.randint(y0+1, shape[0]+1), state.randint(x0+1, shape[1]+1)
+                line = psegutils.record(bounds=(slice(y0, y1), slice(x0, x1)), mask=state.rand(y1-y0, x1-x0) > 0.7)
+                for pad, expand in [(0, 0), (3, 3), (5, 2), (1, 7)]:
+                    for image in [page, array(page, 'i'), 1.0*page]:
+                        expected = psegutils.extract_masked(image, line, pad=pad, expand=expand)
+                        result = psegutils.extract_line(image, line, pad=pad, expand=expand)
+                        self.assertEqual(result.dtype, expected.dtype)
+                        self.assertTrue((result == expected).all())
+
+    def test_thread_pool(self):
+        page = 1-ocrolib.read_image_binary(testImage, 'B')
+        lines = [psegutils.record(bounds=(slice(y, y+40), slice(100, 1500)), mask=ones((40, 1400), bool)) for y in range(0, 1100, 50)]
+        pool = ThreadPool(3)
+        try:
+            result = list(psegutils.extract_lines(page, lines, pad=3, expand=3, pool=pool))
+        finally:
+            pool.terminate()
+        expected = [psegutils.extract_masked(page, l, pad=3, expand=3) for l in lines]
+        self.assertTrue(all((a == b).all() for a, b in zip(result, expected)))
+        self.assertEqual(list(segmentation.line_images(page, lines, 'page', 3, 3, threads=3)),
+                         list(segmentation.line_images(page, lines, 'page', 3, 3)))
+
+
+def decode_runs(counts):
+    """The runs of segmentation.runs_string() (as pycocotools rleFrString)."""
+    runs, p = [], 0
+    while p < len(counts):
+        x, k, more = 0, 0, True
+        while more:
+            c = ord(counts[p])-48
+            x |= (c&0x1f) << 5*k
+            more = c&0x20
+            p, k = p+1, k+1
+            if not more and c&0x10:
+                x |= -1 << 5*k
+        if len(runs) > 2:
+            x += runs[-2]
+        runs.append(x)
+    return runs
+
+
+def decode_mask(mask):
+    """The binary mask of the geometry output."""
+    runs = decode_runs(mask['counts'])
+    values = arange(len(runs))%2
+    return repeat(values, runs).reshape(mask['size'][::-1]).T.astype(bool)
+
+
+class GeometryTest(TestCase):
+
+    def test_geometry_reproduces_line_images(self):
+        with open(testImage, 'rb') as f:
+            data = f.read()
+        response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('page.png', data)})
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        response = self.client.post('/segmentationapi', {'image': SimpleUploadedFile('page.png', data), 'output': 'geometry'})
+        self.assertEqual(response.status_code, 200)
+        geometry = json.loads(response.content)
+        self.assertEqual(geometry['image'], 'page.png')
+        self.assertEqual(len(geometry['lines']), len(archive.namelist()))
+        page = 1-ocrolib.read_image_binary(testImage)
+        self.assertEqual(geometry['shape'], list(page.shape))
+        cleaned = ocrolib.remove_noise(page, geometry['noise'])
+        for i, line in enumerate(geometry['lines']):
+            b = line['bounds']
+            bounds = (slice(b['y0'], b['y1']), slice(b['x0'], b['x1']))
+            mask = decode_mask(line['mask'])
+            self.assertEqual(mask.shape, (b['y1']-b['y0'], b['x1']-b['x0']))
+            image = psegutils.extract_masked(1-cleaned, psegutils.record(bounds=bounds, mask=mask), pad=geometry['pad'], expand=geometry['expand'])
+            expected = ocrolib.read_image_binary(io.BytesIO(archive.read('page_seg/page_%d.png' % (i+1))))
+            self.assertTrue((array(image>0.5, 'i')==expected).all())
+
+    def test_mask_runs(self):
+        self.assertEqual(segmentation.mask_runs(array([[1,1,0],[0,1,1]])), [0,1,1,2,1,1])
+        self.assertEqual(segmentation.mask_runs(array([[0,0],[0,1]])), [3,1])
+        self.assertEqual(segmentation.mask_runs(zeros((2,2))), [4])
+        runs = [0, 3, 40, 7, 1000, 2, 70000, 5, 1]
+        self.assertEqual(decode_runs(segmentation.runs_string(runs)), runs)
+
+
+class MultiresTest(TestCase):
+
+    def bounds(self, multires):
+        with open(testImage, 'rb') as f:
+            response = self.client.post('/segmentationapi', {'image': f, 'output': 'geometry', 'multires': multires})
+        self.assertEqual(response.status_code, 200)
+        geometry = json.loads(response.content)
+        return geometry['scale'], array([[l['bounds'][k] for k in ('y0', 'y1', 'x0', 'x1')] for l in geometry['lines']])
+
+    def test_same_lines_as_full_resolution(self):
+        scale, full = self.bounds(False)
+        _, reduced = self.bounds(True)
+        self.assertEqual(reduced.shape, full.shape)
+        self.assertTrue(abs(reduced-full).max() <= scale/4)
+
+    def test_decimate(self):
+        image = arange(35).reshape(5, 7)
+        reduced = segmentation.decimate(image, 2, 3)
+        self.assertEqual(reduced.shape, (3, 3))
+        self.assertAlmostEqual(reduced[0, 0], mean(image[:2, :3]), places=5)
+        self.assertAlmostEqual(reduced[2, 2], image[4, 6]/6.0, places=5)
+        self.assertEqual(segmentation.upsample(reduced, 2, 3, image.shape).shape, image.shape)
+
+
+def find(a):
+    return flatnonzero(ravel(a))
+
+def column_seeds(bmarked,tmarked,delta,maxgap):
+    """The column by column loop compute_line_seeds() used before seed_runs()."""
+    seeds = zeros(bmarked.shape,'i')
+    for x in range(bmarked.shape[1]):
+        transitions = sorted([(y,1) for y in find(bmarked[:,x])]+[(y,0) for y in find(tmarked[:,x])])[::-1]
+        transitions += [(0,0)]
+        for l in range(len(transitions)-1):
+            y0,s0 = transitions[l]
+            if s0==0: continue
+            seeds[y0-delta:y0,x] = 1
+            y1,s1 = transitions[l+1]
+            if s1==0 and (y0-y1)<maxgap: seeds[y1:y0,x] = 1
+    return seeds
+
+
+class LineSeedsTest(TestCase):
+
+    def test_seed_runs_match_column_loop(self):
+        state = random.RandomState(0)
+        for density in [0.002, 0.02, 0.2]:
+            bmarked = state.rand(90,40)<density
+            tmarked = state.rand(90,40)<density
+            tmarked[:,:3] |= bmarked[:,:3]
+            for delta, maxgap in [(3,20), (6,100.5)]:
+                expected = column_seeds(bmarked,tmarked,delta,maxgap)
+                result = segmentation.seed_runs(bmarked,tmarked,delta,maxgap)
+                self.assertTrue((result==expected).all())
+
+    def test_page_seeds(self):
+        segmentation.args = segmentation.args_default.copy()
+        segmentation.args.update(ParameterSerializer(Parameters()).data)
+        binary = 1-ocrolib.read_image_binary(testImage)
+        scale = psegutils.estimate_scale(binary)
+        binary,_ = segmentation.remove_hlines(array(binary,'B'),scale)
+        colseps,binary = segmentation.compute_colseps(binary,scale)
+        bottom,top,boxmap = segmentation.compute_gradmaps(binary,scale)
+        seeds = segmentation.compute_line_seeds(binary,bottom,top,colseps,scale)
+        # compute_line_seeds() with the column loop
+        t = segmentation.args['threshold']
+        vrange = int(segmentation.args['vscale']*scale)
+        bmarked = maximum_filter(bottom==maximum_filter(bottom,(vrange,0)),(2,2))
+        bmarked = bmarked*(bottom>t*amax(bottom)*t)*(1-colseps)
+        tmarked = maximum_filter(top==maximum_filter(top,(vrange,0)),(2,2))
+        tmarked = tmarked*(top>t*amax(top)*t/2)*(1-colseps)
+        tmarked = maximum_filter(tmarked,(1,20))
+        expected = column_seeds(bmarked,tmarked,max(3,int(scale/2)),5*scale)
+        expected = maximum_filter(expected,(1,int(1+scale)))*(1-colseps)
+        expected,n = morph.label(expected)
+        self.assertEqual(amax(seeds), n)
+        self.assertTrue((seeds==expected).all())
+
+
+class ComponentStatsTest(TestCase):
+
+    def test_statistics_of_components(self):
+        binary = 1-ocrolib.read_image_binary(testImage)
+        stats = morph.ComponentStats(binary)
+        labels, n = morph.label(binary)
+        objects = morph.find_objects(labels)
+        self.assertEqual(stats.n, n)
+        self.assertTrue((stats.labels==labels).all())
+        self.assertEqual(list(stats.height), [sl.height(o) for o in objects])
+        self.assertEqual(list(stats.width), [sl.width(o) for o in objects])
+        self.assertEqual(list(stats.area), [sl.area(o) for o in objects])
+        self.assertEqual(list(stats.counts), list(measurements.sum(binary, labels, range(1, n+1))))
+        self.assertIs(stats.update(array(binary, 'B')), stats)
+        # keeping components renumbers them like labeling the result
+        wide = stats.keep(stats.width>20)
+        labels, n = morph.label(wide.labels>0)
+        self.assertEqual(wide.n, n)
+        self.assertTrue((wide.labels==labels).all())
+        self.assertEqual(wide.objects, morph.find_objects(labels))
+        self.assertIsNot(wide.update(binary), wide)
+
+    def test_shared_statistics_give_the_same_results(self):
+        binary = 1-ocrolib.read_image_binary(testImage)
+        stats = morph.ComponentStats(binary)
+        self.assertEqual(psegutils.estimate_scale(binary, stats=stats), psegutils.estimate_scale(binary))
+        for minsize in [8, 30]:
+            labels, n = morph.label(binary)
+            sums = measurements.sum(binary, labels, range(n+1))[labels]
+            expected = minimum(binary, 1-(sums>0)*(sums<minsize))
+            self.assertTrue((ocrolib.remove_noise(binary, minsize, stats=stats)==expected).all())
+            self.assertTrue((ocrolib.remove_noise(binary, minsize)==expected).all())
+        for f, minimum_score, nbest in [(sl.dim0, 20, 3), (sl.dim1, 3, 10), (sl.area, 0, 0), (sl.aspect, 1, 50)]:
+            labels, n = morph.label(binary)
+            objects = morph.find_objects(labels)
+            scores = [f(o) for o in objects]
+            keep = zeros(n+1, 'i')
+            if nbest > 0:
+                for i in argsort(scores)[-nbest:]:
+                    if scores[i] > minimum_score: keep[i+1] = 1
+            result = morph.select_regions(binary, f, min=minimum_score, nbest=nbest)
+            self.assertTrue((result==keep[labels]).all())
+
+    def test_propagate_labels(self):
+        state = random.RandomState(0)
+        image = filters.maximum_filter(state.rand(80,80)>0.97, 3)
+        seeds, _ = morph.label(filters.maximum_filter(state.rand(80,80)>0.99, (1,9)))
+        rlabels, _ = morph.label(image)
+        expected = zeros(amax(rlabels)+1, 'i')
+        for o, i in morph.correspondences(rlabels, seeds).T:
+            expected[o] = i if expected[o]==0 else -1
+        expected[0] = 0
+        self.assertTrue(any(expected==-1) and any(expected>0))
+        self.assertTrue((morph.propagate_labels(image, seeds, conflict=-1)==expected[rlabels]).all())
+        self.assertTrue((morph.propagate_labels(image, array(seeds, 'uint16'), conflict=-1)==expected[rlabels]).all())
+
+    def test_compact_labels(self):
+        binary = 1-ocrolib.read_image_binary(testImage, 'B')
+        labels, n = morph.small_label(binary)
+        self.assertEqual(labels.dtype, dtype('uint16'))
+        self.assertTrue((labels==morph.label(binary)[0]).all())
+        dots = zeros((600, 600), 'B')
+        dots[::2, ::2] = 1
+        labels, n = morph.small_label(dots)
+        self.assertEqual((labels.dtype, n), (dtype('i'), 90000))
+        self.assertEqual(list(morph.label_counts(labels, n, pixels=1000)), [270000]+[1]*n)
+
+    def test_spread_labels(self):
+        state = random.RandomState(0)
+        seeds, _ = morph.small_label(filters.maximum_filter(state.rand(300, 200)>0.999, (1, 9)))
+        distances, features = morphology.distance_transform_edt(seeds==0, return_indices=1)
+        expected = seeds[features[0], features[1]]*(distances<7.5)
+        spread = morph.spread_labels(seeds, maxdist=7.5, rows=64)
+        self.assertEqual(spread.dtype, seeds.dtype)
+        self.assertTrue((spread==expected).all())
+
+
+class RectangleMorphologyTest(TestCase):
+
+    def tearDown(self):
+        morph.rect_backend = "packed"
+
+    def scipy_results(self, f, image, size, **kw):
+        morph.rect_backend = "scipy"
+        try:
+            return f(image, size, **kw)
+        finally:
+            morph.rect_backend = "packed"
+
+    def test_same_results_as_scipy(self):
+        state = random.RandomState(0)
+        functions = [morph.r_dilation, morph.r_erosion, morph.r_opening, morph.r_closing,
+                     morph.rb_dilation, morph.rb_erosion, morph.rb_opening, morph.rb_closing]
+        for shape, density in [((300, 200), 0.1), ((300, 200), 0.9), ((17, 70), 0.5), ((1, 1), 1)]:
+            image = array(state.rand(*shape) < density, 'B')
+            for size in [(1, 1), (3, 3), (2, 5), (4, 1), (1, 65), (30.5, 30), (101, 3), (400, 301)]:
+                for f in functions:
+                    for a in [image, array(image, 'i'), image > 0]:
+                        expected = self.scipy_results(f, a, size)
+                        result = f(a, size)
+                        self.assertEqual(result.dtype, expected.dtype)
+                        self.assertTrue((result == expected).all(), (f.__name__, shape, size))
+
+    def test_other_images_use_scipy(self):
+        image = zeros((20, 20), 'B')
+        image[5:9, 5:9] = 255
+        self.assertEqual(amax(morph.r_dilation(image, (3, 3))), 255)
+        image = array(image > 0, 'i')
+        self.assertTrue((morph.r_dilation(image, (3, 3), origin=1) == self.scipy_results(morph.r_dilation, image, (3, 3), origin=1)).all())
+
+
+def painted_scale(binary):
+    """estimate_scale() as it was, painting each box on a full page map."""
+    objects = psegutils.binary_objects(binary)
+    scalemap = zeros(binary.shape)
+    for o in sorted(objects,key=sl.area):
+        if amax(scalemap[o])>0: continue
+        scalemap[o] = sl.area(o)**0.5
+    return median(scalemap[(scalemap>3)&(scalemap<100)])
+
+def painted_boxmap(binary,scale,threshold=(.5,4)):
+    """compute_boxmap() as it was."""
+    boxmap = zeros(binary.shape,'i')
+    for o in psegutils.binary_objects(binary):
+        if sl.area(o)**.5<threshold[0]*scale: continue
+        if sl.area(o)**.5>threshold[1]*scale: continue
+        boxmap[o] = 1
+    return boxmap
+
+
+class ScaleTest(TestCase):
+
+    def test_scale_and_boxmap_match_painting(self):
+        page = 1-ocrolib.read_image_binary(testImage)
+        state = random.RandomState(0)
+        noisy = where(state.rand(*page.shape)<0.03,1-page,page)
+        # L shapes of many sizes, whose boxes overlap in chains
+        shapes = zeros((300,400),'i')
+        for y, x, h, w in zip(state.randint(0,260,150), state.randint(0,360,150), state.randint(1,40,150), state.randint(1,40,150)):
+            shapes[y:y+h,x] = 1
+            shapes[y+h-1,x:x+w] = 1
+        for binary in [page, noisy, shapes]:
+            scale = painted_scale(binary)
+            self.assertEqual(psegutils.estimate_scale(binary), scale)
+            stats = morph.ComponentStats(binary)
+            self.assertEqual(psegutils.estimate_scale(binary, stats=stats), scale)
+            self.assertTrue((psegutils.compute_boxmap(binary, scale, stats=stats)==painted_boxmap(binary, scale)).all())
+        self.assertTrue(isnan(psegutils.estimate_scale(zeros((20,20),'i'))))
+
+
+def synthetic_lines(n,columns=3,seed=0):
+    """The shuffled line boxes of a page of n lines in columns, with some
+    lines across all the columns."""
+    state = random.RandomState(seed)
+    lines = []
+    for k in range(n):
+        column, row = k%columns, k//columns
+        y, x = 30*row+state.randint(0,8), 700*column+state.randint(0,40)
+        w = state.randint(100,650) if state.rand()>0.05 else 700*columns-50
+        lines.append((slice(y,y+state.randint(10,28)),slice(x,x+w)))
+    state.shuffle(lines)
+    return lines
+
+def recursive_topsort(order):
+    """topsort() as it was, recursing once per element."""
+    visited = zeros(len(order))
+    L = []
+    def visit(k):
+        if visited[k]: return
+        visited[k] = 1
+        for l in find(order[:,k]):
+            visit(l)
+        L.append(k)
+    for k in range(len(order)):
+        visit(k)
+    return L
+
+
+class ReadingOrderTest(TestCase):
+
+    def test_same_order_as_pairwise_separators(self):
+        state = random.RandomState(0)
+        for k in range(20):
+            y, x = state.randint(0,60,(2,40))
+            h, w = state.randint(1,15,(2,40))
+            lines = [(slice(a,a+b),slice(c,c+d)) for a, b, c, d in zip(y, h, x, w)]
+            self.assertTrue((psegutils.reading_order(lines)==psegutils.reading_order_pairs(lines)).all())
+        lines = synthetic_lines(100)
+        order = psegutils.reading_order(lines)
+        self.assertTrue((order==psegutils.reading_order_pairs(lines)).all())
+        self.assertEqual(psegutils.topsort(order), recursive_topsort(order))
+        self.assertEqual(len(psegutils.reading_order([])), 0)
+
+    def test_topsort_of_long_chains(self):
+        # a ledger of lines listed bottom up recursed once per line
+        lines = [(slice(20*k,20*k+12),slice(10,900)) for k in range(2000)][::-1]
+        self.assertEqual(psegutils.topsort(psegutils.reading_order(lines)), list(range(1999,-1,-1)))
@@ -26,14 +26,14 @@ from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.shortcuts import render
 from .models import Parameters
 from .serializers import ParameterSerializer
-from .segmentation import segmentation_exec
-from .extrafunc import del_service_files
-import sys, os, os.path, zipfile, StringIO
+from .segmentation import segmentation_exec, file_digest
+import sys, os, os.path, zipfile
+import ocrolib
 import time
 import logging
 
@@ -45,6 +45,87 @@ dataDir = settings.MEDIA_ROOT
 def index(request):
     return render(request, 'index.html')
 
+class ZipStream(object):
+    """Write-only file object collecting the bytes written by zipfile, so
+    that the archive can be sent to the client entry by entry."""
+    def __init__(self):
+        self.data = []
+        self.position = 0
+    def write(self, data):
+        self.data.append(data)
+        self.position += len(data)
+    def tell(self):
+        return self.position
+    def flush(self):
+        pass
+    def pop(self):
+        data = b''.join(self.data)
+        self.data = []
+        return data
+
+def number_of_pages(image):
+    try:
+        return ocrolib.number_of_pages(image)
+    except Exception:
+        return 1
+
+def stream_lines(lines, zip_dir, receive_req):
+    """Yield the zip archive of the lines of a page, line by line, as the
+    lines are extracted and encoded. The lines are in the folder
+    {imagename}_seg."""
+    logger = logging.getLogger('django')
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, "w")
+    for name, data in lines:
+        archive.writestr(str(os.path.join(zip_dir, name)), data)
+        yield stream.pop()
+    archive.close()
+    logger.info("*** Service time: %.2fs ***" % (time.time()-receive_req))
+    yield stream.pop()
+
+def stream_pages(image_object, parameters, receive_req):
+    """Segment the pages of a multi-page image one at a time and yield the
+    zip archive of their lines, line by line. Each page's lines are in the
+    folder {imagename}_seg/{imagename}_{page}."""
+    logger = logging.getLogger('django')
+    imagename_base, ext = os.path.splitext(str(image_object))
+    zip_dir = imagename_base+"_seg"
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, "w")
+    digest = file_digest(image_object)
+    for pageno in range(number_of_pages(image_object)):
+        page_base = "%s_%04d" % (imagename_base, pageno+1)
+        lines = segmentation_exec((image_object, pageno), parameters, digest)
+        if not lines:
+            logger.error("sth wrong with segmentation of page %d" % (pageno+1))
+            archive.writestr(str(os.path.join(zip_dir, page_base+"_error.txt")), b"ERROR: sth wrong with segmentation")
+        for name, data in lines or []:
+            archive.writestr(str(os.path.join(zip_dir, page_base, name)), data)
+            yield stream.pop()
+        logger.info("*** Page %d: %.2fs ***" % (pageno+1, time.time()-receive_req))
+    archive.close()
+    logger.info("*** Service time: %.2fs ***" % (time.time()-receive_req))
+    yield stream.pop()
+
+def geometry_response(image_object, parameters, receive_req):
+    """The line geometry of the image (see segmentation.page_geometry()),
+    or the list of the geometries of the pages of a multi-page image,
+    with null for the pages that could not be segmented."""
+    logger = logging.getLogger('django')
+    n = number_of_pages(image_object)
+    if n > 1:
+        digest = file_digest(image_object)
+        pages = [segmentation_exec((image_object, pageno), parameters, digest) or None for pageno in range(n)]
+        result = dict(image=str(image_object), pages=pages)
+    else:
+        result = segmentation_exec(image_object, parameters)
+        if not result:
+            logger.error("sth wrong with segmentation")
+            return Response("ERROR: sth wrong with segmentation", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        result['image'] = str(image_object)
+    logger.info("*** Service time: %.2fs ***" % (time.time()-receive_req))
+    return Response(result)
+
 @csrf_exempt
 @api_view(['GET', 'POST'])
 def segmentationView(request, format=None):
@@ -61,61 +142,40 @@ def segmentationView(request, format=None):
     else:
         logger.error(paras_serializer.errors)
         return Response(paras_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-    
+    parameters = paras_serializer.data
+    # Delete data in database
+    Parameters.objects.filter(id=parameters['id']).delete()
+
     image_object = request.FILES['image']
+    imagename_base, ext = os.path.splitext(str(image_object))
+    ### Only the geometry of the lines, as JSON
+    if parameters['output'] == 'geometry':
+        return geometry_response(image_object, parameters, receive_req)
+
+    ### Segment the pages of a multi-page image one by one, streaming the zip
+    if number_of_pages(image_object) > 1:
+        response = StreamingHttpResponse(stream_pages(image_object, parameters, receive_req), content_type="application/x-zip-compressed")
+        response["Content-Disposition"] = 'attachment; filename=%s_seg.zip' % imagename_base
+        return response
+
     ### Call segmentation function
     seg_begin = time.time()
-    #imagepath = projectDir + paras_serializer.data['image']
-    output_list = segmentation_exec(image_object, paras_serializer.data)
-    # output_dic: key--line NO. value--line image object
-    #output_dic = segmentation_exec(image_object, paras_serializer.data)
+    # lines: generator of the (name, PNG data) of the line images
+    lines = segmentation_exec(image_object, parameters)
     seg_end = time.time()
-    if not output_list: # if output_list is empty
-        Parameters.objects.filter(id=paras_serializer.data['id']).delete()
-        del_service_files(dataDir)
+    if not lines: # if the segmentation failed
         logger.error("sth wrong with segmentation")
         return Response("ERROR: sth wrong with segmentation", status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    ### return the multiple files in zip type
-    # Folder name in ZIP archive which contains the above files
-    imagename_base, ext = os.path.splitext(str(image_object))
+    ### Stream the zip of the line images while the later lines are extracted
+    # Folder name in ZIP archive which contains the line images
     zip_dir = imagename_base+"_seg"
     zip_filename = "%s.zip" % zip_dir
-    # Open StringIO to grab in-memory ZIP contents
-    strio = StringIO.StringIO()
-    # The zip compressor
-    zf = zipfile.ZipFile(strio, "w")
-
-    ### Zip multiple image files from disk
-    for fpath in output_list:
-        # Caculate path for file in zip
-        fdir, fname = os.path.split(fpath)
-        zip_path = os.path.join(zip_dir, fname)
-        # Add file, at correct path
-        zf.write(fpath, zip_path)
-    """
-    ### Zip multiple image objects from memory
-    for key in output_dic:
-        line_name = str(image_object)+str(key)+".png"
-        zip_path = os.path.join(zip_dir, line_name)
-        zf.write(output_dic[key], zip_path)
-    """
-    zf.close()
-    # Grab ZIP file from in-memory, make response with correct MIME-type
-    response = HttpResponse(strio.getvalue(), content_type="application/x-zip-compressed")
+    response = StreamingHttpResponse(stream_lines(lines, zip_dir, receive_req), content_type="application/x-zip-compressed")
     # And correct content-disposition
     response["Content-Disposition"] = 'attachment; filename=%s' % zip_filename
-    
-    ### Delete all datas generated during this service
-    # Delete data in database
-    Parameters.objects.filter(id=paras_serializer.data['id']).delete()
-    # Delete files in local storage
-    del_service_files(dataDir)
 
-    send_resp = time.time()
     logger.info("===== Image %s =====" % str(image_object))
     logger.info("*** Before seg: %.2fs ***" % (seg_begin-receive_req))
     logger.info("*** Seg: %.2fs ***" % (seg_end-seg_begin))
-    logger.info("*** After seg: %.2fs ***" % (send_resp-seg_end))
-    logger.info("*** Service time: %.2fs ***" % (send_resp-receive_req))
     return response
@@ -4,6 +4,7 @@ from toplevel import *
 from pylab import *
 from scipy.ndimage import filters,interpolation
 import sl,morph
+import functools,itertools
 
 def B(a):
     if a.dtype==dtype('B'): return a
@@ -39,25 +40,94 @@ def binary_objects(binary):
     objects = morph.find_objects(labels)
     return objects
 
-def estimate_scale(binary):
-    objects = binary_objects(binary)
-    bysize = sorted(objects,key=sl.area)
-    scalemap = zeros(binary.shape)
-    for o in bysize:
-        if amax(scalemap[o])>0: continue
-        scalemap[o] = sl.area(o)**0.5
-    scale = median(scalemap[(scalemap>3)&(scalemap<100)])
-    return scale
-
-def compute_boxmap(binary,scale,threshold=(.5,4),dtype='i'):
-    objects = binary_objects(binary)
-    bysize = sorted(objects,key=sl.area)
-    boxmap = zeros(binary.shape,dtype)
-    for o in bysize:
-        if sl.area(o)**.5<threshold[0]*scale: continue
-        if sl.area(o)**.5>threshold[1]*scale: continue
-        boxmap[o] = 1
-    return boxmap
+def box_coverage(shape,y0,y1,x0,x1):
+    """The number of boxes covering each pixel, from cumulative sums of
+    the +1/-1 corners of the boxes."""
+    corners = zeros((shape[0]+1,shape[1]+1),'i')
+    add.at(corners,(y0,x0),1)
+    add.at(corners,(y0,x1),-1)
+    add.at(corners,(y1,x0),-1)
+    add.at(corners,(y1,x1),1)
+    coverage = cumsum(corners,axis=0,dtype='i')
+    return cumsum(coverage,axis=1,dtype='i',out=coverage)[:-1,:-1]
+
+def box_sums(image,y0,y1,x0,x1):
+    """The sums of the image over the boxes, from its summed area table."""
+    table = zeros((image.shape[0]+1,image.shape[1]+1),'i')
+    cumsum(image,axis=0,out=table[1:,1:])
+    cumsum(table[1:,1:],axis=1,out=table[1:,1:])
+    return table[y1,x1]-table[y0,x1]-table[y1,x0]+table[y0,x0]
+
+def overlapping_boxes(y0,y1,x0,x1):
+    """The pairs (i,j) of boxes that overlap, with i<j."""
+    rows = argsort(y0,kind='mergesort')
+    # the boxes starting within the rows of each box
+    lo = searchsorted(y0[rows],y0,'left')
+    counts = searchsorted(y0[rows],y1,'left')-lo
+    j = repeat(arange(len(y0)),counts)
+    offsets = arange(len(j))-repeat(cumsum(counts)-counts,counts)
+    i = rows[repeat(lo,counts)+offsets]
+    keep = (i!=j)&(x0[i]<x1[j])&(x0[j]<x1[i])
+    i,j = i[keep],j[keep]
+    pairs = unique(minimum(i,j)*len(y0)+maximum(i,j))
+    return pairs//len(y0),pairs%len(y0)
+
+def painted_boxes(shape,y0,y1,x0,x1,order):
+    """Paints the boxes in the given order, skipping the boxes that
+    overlap a box painted before them, and returns which ones are
+    painted.  Only the boxes overlapping other boxes need deciding, in
+    rounds: a box is skipped once a box before it is painted, and
+    painted once all the boxes before it are skipped."""
+    n = len(y0)
+    painted = ones(n,bool)
+    if n==0: return painted
+    crowded = box_sums(box_coverage(shape,y0,y1,x0,x1)>1,y0,y1,x0,x1)>0
+    crowded = flatnonzero(crowded)
+    rank = zeros(n,int)
+    rank[order] = arange(n)
+    a,b = overlapping_boxes(y0[crowded],y1[crowded],x0[crowded],x1[crowded])
+    a,b = crowded[a],crowded[b]
+    swap = rank[a]>rank[b]
+    a,b = where(swap,b,a),where(swap,a,b)
+    # -1: undecided, 0: skipped, 1: painted
+    state = -ones(n,int)
+    state[setdiff1d(arange(n),b)] = 1
+    while len(b)>0:
+        state[b[state[a]==1]] = 0
+        waiting = bincount(b[state[a]==-1],minlength=n)
+        state[(state==-1)&(waiting==0)] = 1
+        undecided = (state[b]==-1)
+        a,b = a[undecided],b[undecided]
+    return state==1
+
+def estimate_scale(binary,stats=None):
+    """The median size of the components; `stats` are the
+    morph.ComponentStats of binary, if already computed.  The sizes of
+    the components are painted over their boxes from the smallest to
+    the largest, skipping boxes that overlap boxes painted before, and
+    the median is taken over the pixels with sizes between 3 and 100."""
+    if stats is None: stats = morph.ComponentStats(binary)
+    order = argsort(stats.area,kind='mergesort')
+    painted = painted_boxes(binary.shape,stats.y0,stats.y1,stats.x0,stats.x1,order)
+    # the painted boxes do not overlap, so each pixel of the median
+    # comes from one box
+    sizes = stats.area**0.5
+    painted &= (sizes>3)&(sizes<100)
+    sizes,weights = sizes[painted],stats.area[painted]
+    if sum(weights)==0: return nan
+    order = argsort(sizes,kind='mergesort')
+    sizes,ends = sizes[order],cumsum(weights[order])
+    n = ends[-1]
+    middle = sizes[searchsorted(ends,[(n-1)//2,n//2],'right')]
+    return mean(middle)
+
+def compute_boxmap(binary,scale,threshold=(.5,4),dtype='B',stats=None):
+    if stats is None: stats = morph.ComponentStats(binary)
+    sizes = stats.area**.5
+    selected = (sizes>=threshold[0]*scale)&(sizes<=threshold[1]*scale)
+    coverage = box_coverage(binary.shape,stats.y0[selected],stats.y1[selected],
+                            stats.x0[selected],stats.x1[selected])
+    return array(coverage>0,dtype)
 
 def compute_lines(segmentation,scale):
     """Given a line segmentation map, computes a list
@@ -121,11 +191,101 @@ def extract_masked(image,linedesc,pad=5,expand=0):
     line = where(mask,line,amax(line))
     return line
 
+def extract_line(image,linedesc,pad=5,expand=0):
+    """The extract_masked() of a line, by slicing the page into a buffer
+    of the padded size and replicating its edges where the padding
+    leaves the page, and by dilating the mask only within its bounds
+    grown by the dilation.  Lines whose padded box is larger than the
+    page are extracted by extract_masked()."""
+    h,w = image.shape
+    y0,y1,x0,x1 = sl.raster(linedesc.bounds)
+    y0,x0,y1,x1 = y0-pad,x0-pad,y1+pad,x1+pad
+    if y1-y0>h or x1-x0>w:
+        return extract_masked(image,linedesc,pad=pad,expand=expand)
+    line = empty((y1-y0,x1-x0),image.dtype)
+    # the part within the page, then the edges outside of it
+    top,bottom,left,right = max(0,-y0),max(0,y1-h),max(0,-x0),max(0,x1-w)
+    line[top:y1-y0-bottom,left:x1-x0-right] = image[y0+top:y1-bottom,x0+left:x1-right]
+    if top>0: line[:top] = line[top]
+    if bottom>0: line[-bottom:] = line[-bottom-1]
+    if left>0: line[:,:left] = line[:,left:left+1]
+    if right>0: line[:,-right:] = line[:,-right-1:-right]
+    mask = zeros(line.shape,bool)
+    mh,mw = linedesc.mask.shape
+    mask[pad:pad+mh,pad:pad+mw] = linedesc.mask
+    if expand>0:
+        # the dilation of the mask stays within these bounds
+        before,after = expand-1-expand//2,expand//2
+        r0,r1 = max(0,pad-before),min(mask.shape[0],pad+mh+after)
+        c0,c1 = max(0,pad-before),min(mask.shape[1],pad+mw+after)
+        mask[r0:r1,c0:c1] = filters.maximum_filter(mask[r0:r1,c0:c1],(expand,expand),mode='constant',cval=0)
+    line[~mask] = amax(line)
+    return line
+
+def extract_lines(image,lines,pad=5,expand=0,pool=None):
+    """The extract_line() of each of the lines, in order, as an iterator.
+    The lines are extracted by `pool` if given (a thread pool, such as
+    multiprocessing.pool.ThreadPool, so that the page is not copied)."""
+    extract = functools.partial(extract_line,image,pad=pad,expand=expand)
+    if pool is None: return itertools.imap(extract,lines)
+    return pool.imap(extract,lines)
+
 def reading_order(lines,highlight=None,debug=0):
     """Given the list of lines (a list of 2D slices), computes
     the partial reading order.  The output is a binary 2D array
     such that order[i,j] is true if line i comes before line j
-    in reading order."""
+    in reading order.
+
+    Line i comes before line j if they overlap horizontally and i
+    starts higher, or if i is left of j and no line w separates
+    them, i.e. w spans the gap between them (w starts left of the
+    end of i and ends right of the start of j) within their rows.
+    For each line i, the lines w starting left of its end are put in
+    an index sorted by rows, with running maxima of their right ends,
+    so that the separated lines j are found with searchsorted(): O(n^2 log n)
+    in the worst case, with a Python loop of n numpy steps."""
+    if highlight is not None:
+        return reading_order_pairs(lines,highlight,debug)
+    n = len(lines)
+    order = zeros((n,n),'B')
+    if n==0: return order
+    y0,y1,x0,x1 = array([sl.raster(l) for l in lines]).T
+    xov = (x0[:,newaxis]<x1[newaxis,:])&(x1[:,newaxis]>x0[newaxis,:])
+    order[xov&(y0[:,newaxis]<y0[newaxis,:])] = 1
+    for i in range(n):
+        right = flatnonzero(x1[i]<x0)
+        if len(right)==0: continue
+        y0j,y1j,x0j = y0[right],y1[right],x0[right]
+        # w separates i and j if it reaches their rows:
+        # w.y1>=min(y0[i],y0[j]) and w.y0<=max(y1[i],y1[j])
+        w = flatnonzero(x0<x1[i])
+        reaches_top = (y1[w]>=y0[i])
+        reaches_bottom = (y0[w]<=y1[i])
+        separated = zeros(len(right),bool)
+        both = w[reaches_top&reaches_bottom]
+        if len(both)>0:
+            separated |= amax(x1[both])>x0j
+        # w below i must start above the end of j
+        below = w[reaches_top&~reaches_bottom]
+        if len(below)>0:
+            rows = argsort(y0[below])
+            reach = maximum.accumulate(x1[below][rows])
+            k = searchsorted(y0[below][rows],y1j,'right')
+            separated |= (k>0)&(reach[maximum(k-1,0)]>x0j)
+        # w above i must end below the start of j
+        above = w[reaches_bottom&~reaches_top]
+        if len(above)>0:
+            rows = argsort(y1[above])
+            reach = maximum.accumulate(x1[above][rows][::-1])[::-1]
+            k = searchsorted(y1[above][rows],y0j,'left')
+            separated |= (k<len(above))&(reach[minimum(k,len(above)-1)]>x0j)
+        order[i,right[~separated]] = 1
+    return order
+
+def reading_order_pairs(lines,highlight=None,debug=0):
+    """reading_order() by checking every line as a separator of
+    every pair of lines, in O(n^3).  It can highlight the lines
+    before a given line, for debugging."""
     order = zeros((len(lines),len(lines)),'B')
     def x_overlaps(u,v):
         return u[1].start<v[1].stop and u[1].stop>v[1].start
@@ -159,19 +319,28 @@ def reading_order(lines,highlight=None,debug=0):
 
 def topsort(order):
     """Given a binary array defining a partial order (o[i,j]==True means i<j),
-    compute a topological sort.  This is a quick and dirty implementation
-    that works for up to a few thousand elements."""
+    compute a topological sort.  This is the depth first search of the
+    predecessors of each element, with an explicit stack instead of
+    recursion, so that it works for any number of elements."""
     n = len(order)
-    visited = zeros(n)
+    visited = zeros(n,bool)
+    predecessors = ascontiguousarray(transpose(order))
     L = []
-    def visit(k):
-        if visited[k]: return
-        visited[k] = 1
-        for l in find(order[:,k]):
-            visit(l)
-        L.append(k)
     for k in range(n):
-        visit(k)
+        if visited[k]: continue
+        visited[k] = 1
+        stack = [(k,flatnonzero(predecessors[k]))]
+        while stack:
+            k,before = stack[-1]
+            before = before[~visited[before]]
+            if len(before)==0:
+                stack.pop()
+                L.append(k)
+                continue
+            stack[-1] = (k,before[1:])
+            l = before[0]
+            visited[l] = 1
+            stack.append((l,flatnonzero(predecessors[l])))
     return L #[::-1]
 
 def show_lines(image,lines,lsort):
@@ -293,7 +293,7 @@ except: pass
 def AFLOAT(a):
     return a.dtype in float_dtypes
 
-int_dtypes = [numpy.dtype('uint8'),numpy.dtype('int32'),numpy.dtype('int64'),numpy.dtype('uint32'),numpy.dtype('uint64')]
+int_dtypes = [numpy.dtype('uint8'),numpy.dtype('int16'),numpy.dtype('uint16'),numpy.dtype('int32'),numpy.dtype('int64'),numpy.dtype('uint32'),numpy.dtype('uint64')]
 
 @makeargcheck("array must contain integer values")
 def AINT(a):
@@ -351,12 +351,10 @@ AFLOAT3 = ALL(ARANK(3),AFLOAT)
 def ABINARY(a):
     if a.ndim==2 and a.dtype==numpy.dtype(bool): return 1
     if not a.dtype in int_dtypes: return 0
-    import scipy.ndimage.measurements
-    zeros,ones = scipy.ndimage.measurements.sum(1,a,[0,1])
-    if zeros+ones == a.size: return 1
+    # the extremes do not need a temporary array of the size of a page
+    if a.size==0 or (numpy.amin(a)>=0 and numpy.amax(a)<=1): return 1
     if a.dtype==numpy.dtype('B'):
-        zeros,ones = scipy.ndimage.measurements.sum(1,a,[0,255])
-        if zeros+ones == a.size: return 1
+        if numpy.count_nonzero(a==0)+numpy.count_nonzero(a==255) == a.size: return 1
     return 0
 
 ABINARY1 = ALL(ABINARY,ARRAY1)
@@ -410,7 +408,7 @@ def PATCH(a):
 
 @makeargcheck("expected a segmentation image")
 def SEGMENTATION(a):
-    return isinstance(a,numpy.ndarray) and a.ndim==2 and a.dtype in ['int32','int64']
+    return isinstance(a,numpy.ndarray) and a.ndim==2 and a.dtype in ['uint16','int32','int64']
 @makeargcheck("expected a segmentation with white background")
 def WHITESEG(a):
     return numpy.amax(a)==0xffffff
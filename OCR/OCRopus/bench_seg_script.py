@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+##########################################################################################
+# Description:
+#	Benchmarks of the segmentation code of ocrolib, run locally on this machine (the
+# microservice is not needed). They regenerate the tables of SegmentationService/README.md:
+#	python bench_seg_script.py reading_order [-n 100 500 2000] [--before]
+#	python bench_seg_script.py morphology [--zoom 3] [--sizes 3 11 31 101 301]
+##########################################################################################
+# Copyright 2017    Advanced Computing and Information Systems (ACIS) Lab - UF
+#                   (https://www.acis.ufl.edu/)
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##########################################################################################
+
+import time, argparse, os, sys
+
+### The segmentation service holds ocrolib and the synthetic pages of its tests
+serviceDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SegmentationService")
+sys.path.insert(0, serviceDir)
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "SegmentationService.settings")
+
+def seconds(f, repeat=3):
+    """The best wall time of `repeat` calls of f()."""
+    best = None
+    for _ in range(repeat):
+        begin = time.time()
+        f()
+        t = time.time()-begin
+        best = t if best is None else min(best, t)
+    return best
+
+### Reading order and topological sort of synthetic pages of lines in three columns
+def bench_reading_order(args):
+    import django
+    django.setup()
+    from ocrolib import psegutils
+    from api.tests import synthetic_lines, recursive_topsort
+    columns = ["lines", "reading_order", "topsort"]
+    if args.before:
+        columns += ["reading_order_pairs", "recursive topsort"]
+    print("| " + " | ".join(columns) + " |")
+    print("|" + "---|"*len(columns))
+    for n in args.n:
+        lines = synthetic_lines(n)
+        order = psegutils.reading_order(lines)
+        row = [n, seconds(lambda: psegutils.reading_order(lines)), seconds(lambda: psegutils.topsort(order))]
+        if args.before:
+            # O(n^3): about a minute for 500 lines
+            row += [seconds(lambda: psegutils.reading_order_pairs(lines), repeat=1), seconds(lambda: recursive_topsort(order))]
+        print("| " + " | ".join(["%d" % row[0]] + ["%.3fs" % t for t in row[1:]]) + " |")
+        sys.stdout.flush()
+
+### Rectangular morphology of the sample page with both rect_backend of ocrolib.morph
+def bench_morphology(args):
+    import django
+    django.setup()
+    import logging
+    logging.getLogger('django').setLevel(logging.WARNING)
+    import numpy
+    from scipy.ndimage import interpolation
+    import ocrolib
+    from ocrolib import morph, psegutils
+    from api import segmentation
+    from api.models import Parameters
+    from api.serializers import ParameterSerializer
+    binary = 1-ocrolib.read_image_binary(os.path.join(serviceDir, "testimages", "NY01075759_lg_bin.png"), 'B')
+    if args.zoom > 1:
+        binary = numpy.array(interpolation.zoom(binary, args.zoom, order=0), 'B')
+    print("Seconds per call on a %dx%d page, for square elements:" % binary.shape)
+    print("")
+    print("| function | backend | " + " | ".join("%dx%d" % (k, k) for k in args.sizes) + " |")
+    print("|---|---|" + "---|"*len(args.sizes))
+    backend = morph.rect_backend
+    try:
+        for name in ["r_dilation", "r_erosion", "rb_opening", "rb_closing"]:
+            f = getattr(morph, name)
+            results = {}
+            for morph.rect_backend in ["scipy", "packed"]:
+                times = []
+                for k in args.sizes:
+                    times.append(seconds(lambda: f(binary, (k, k))))
+                    result = numpy.asarray(f(binary, (k, k)), 'B')
+                    if results.setdefault(k, result) is not result:
+                        assert (results[k] == result).all(), "%s %dx%d differs between the backends" % (name, k, k)
+                row = " | ".join("%.3f" % t for t in times)
+                print("| `%s` | %s | %s |" % (name, morph.rect_backend, row))
+                sys.stdout.flush()
+        # the page segmentation steps built on the rectangular morphology
+        segmentation.args = segmentation.args_default.copy()
+        segmentation.args.update(ParameterSerializer(Parameters()).data)
+        segmentation.args.update(quiet=True, maxseps=2)
+        scale = psegutils.estimate_scale(binary)
+        print("")
+        for morph.rect_backend in ["scipy", "packed"]:
+            print("%s: compute_separators_morph() %.2fs, compute_colseps_mconv() %.2fs" % (morph.rect_backend,
+                seconds(lambda: segmentation.compute_separators_morph(binary, scale)),
+                seconds(lambda: segmentation.compute_colseps_mconv(binary, scale))))
+    finally:
+        morph.rect_backend = backend
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the segmentation code of ocrolib")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("reading_order", help="psegutils.reading_order() and topsort() of synthetic pages")
+    command.add_argument("-n", type=int, nargs="+", default=[100, 500, 2000], help="numbers of lines of the pages")
+    command.add_argument("--before", action="store_true", help="also time the O(n^3) reading_order_pairs() and the recursive topsort")
+    command.set_defaults(bench=bench_reading_order)
+    command = commands.add_parser("morphology", help="morph.r_* and morph.rb_* with rect_backend packed and scipy")
+    command.add_argument("--zoom", type=int, default=1, help="enlarge the sample page by this factor")
+    command.add_argument("--sizes", type=int, nargs="+", default=[3, 11, 31, 101, 301], help="sizes of the square elements")
+    command.set_defaults(bench=bench_morphology)
+    args = parser.parse_args()
+    args.bench(args)
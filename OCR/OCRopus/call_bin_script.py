@@ -47,6 +47,19 @@ parser.add_argument('-m','--maxskew',type=float,default=argparse.SUPPRESS, help=
 parser.add_argument('--lo',type=float,default=argparse.SUPPRESS, help='percentile for black estimation')
 parser.add_argument('--hi',type=float,default=argparse.SUPPRESS, help='percentile for white estimation')
 parser.add_argument('--skewsteps',type=int,default=argparse.SUPPRESS, help='steps for skew angle estimation (per degree)')
+parser.add_argument('--skewmethod',choices=['shear','rotate'],default=argparse.SUPPRESS, help='skew angle estimation method (rotate=reference)')
+parser.add_argument('--flatmethod',choices=['scipy','histogram'],default=argparse.SUPPRESS, help='percentile filter for background flattening')
+parser.add_argument('--maxmem',type=int,default=argparse.SUPPRESS, help='memory budget (MB) for binarizing large pages in strips (0=whole page)')
+parser.add_argument('--precision',choices=['float64','float32'],default=argparse.SUPPRESS, help='floating point precision of the binarization pipeline')
+parser.add_argument('--decode',choices=['mean','luma'],default=argparse.SUPPRESS, help='grayscale of color images (luma=faster decoding of JPEGs)')
+parser.add_argument('--maskmethod',choices=['full','decimated'],default=argparse.SUPPRESS, help='resolution of the escale text region mask')
+parser.add_argument('--algorithm',choices=['nlbin','sauvola','niblack'],default=argparse.SUPPRESS, help='binarizer (sauvola/niblack=local thresholds, faster)')
+parser.add_argument('--window',type=int,default=argparse.SUPPRESS, help='window size of the sauvola and niblack algorithms')
+parser.add_argument('-k',type=float,default=argparse.SUPPRESS, help='weight of the window standard deviation (sauvola and niblack)')
+parser.add_argument('--output_format',choices=['png','png1','tiffg4','packbits'],default=argparse.SUPPRESS, help='encoding of the binarized images')
+parser.add_argument('--thresholds',default=argparse.SUPPRESS, help='sweep: comma separated thresholds, e.g. 0.4,0.5,0.6 (one zip per image)')
+parser.add_argument('--percentiles',default=argparse.SUPPRESS, help='sweep: comma separated lo:hi percentile pairs, e.g. 5:90,10:95 (one zip per image)')
+parser.add_argument('--batch',type=int,default=0, help='send the images of a folder N at a time to the batch service (0=one request per image)')
 
 args = parser.parse_args()
 
@@ -64,8 +77,29 @@ else:
 args = vars(args)
 
 
+def call_bin_batch(imagepaths, dstDir, parameters):
+	url_bin = "http://" + IP + ":" + PORT + "/binarizationapi/batch"
+
+	# Uploaded images, all with the key 'image'
+	images = [('image', open(imagepath, 'rb')) for imagepath in imagepaths]
+
+	# Call binarization batch service
+	call_begin = time.time()
+	resp = requests.get(url_bin, files=images, data=parameters)
+	print("*** Binarization batch service time (%d images): %.2f seconds**" % (len(imagepaths), time.time()-call_begin))
+
+	# Extract the responsed binarized images
+	if resp.status_code == 200:
+		zipfile.ZipFile(StringIO.StringIO(resp.content)).extractall(dstDir)
+	else:
+		print("Batch %s Binarization error!" % ", ".join(imagepaths))
+
+
 def call_bin(imagepath, dstDir, parameters):
 	url_bin = "http://" + IP + ":" + PORT + "/binarizationapi"
+	sweep = 'thresholds' in parameters or 'percentiles' in parameters
+	if sweep:
+		url_bin += "/sweep"
 
 	# Uploaded iamges
 	image = {'image': open(imagepath, 'rb')}
@@ -79,7 +113,10 @@ def call_bin(imagepath, dstDir, parameters):
 	# Save the responsed binarized image
 	image = os.path.basename(imagepath)
 	image_name, image_ext = os.path.splitext(image)
-	dstimage = image_name + "_bin.png"
+	extensions = {'tiffg4': ".tif", 'packbits': ".bin"}
+	dstimage = image_name + "_bin" + extensions.get(parameters.get('output_format'), ".png")
+	if sweep:
+		dstimage = image_name + "_sweep.zip"
 	dstpath = os.path.join(dstDir, dstimage)
 
 	if resp.status_code == 200:
@@ -99,11 +136,20 @@ if __name__ == '__main__':
 	### Only keep the setable parameters
 	del args['image']
 	del args['output']
+	batch = args.pop('batch')
 
 	### Call binarization service
 	if os.path.isfile(image):
 		print("\n===== %s ======" % image)
 		call_bin(image, dstDir, args)
+	elif os.path.isdir(image) and batch > 0:
+		image_paths = [os.path.join(image, image_name) for image_name in sorted(os.listdir(image))]
+		for i in range(0, len(image_paths), batch):
+			# One batch failed do not affect the process of other batches
+			try:
+				call_bin_batch(image_paths[i:i+batch], dstDir, args)
+			except:
+				pass
 	elif os.path.isdir(image):
 		for image_name in os.listdir(image):
 			image_path = os.path.join(image, image_name)
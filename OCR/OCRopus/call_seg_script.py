@@ -49,6 +49,7 @@ parser.add_argument('image', help="The path of a image file, or a folder contain
 
 # output parameters
 parser.add_argument('-o','--output', default=None, help="output directory, without the last slash")
+parser.add_argument('--geometry', action='store_true', help="save the line bounds and masks as {imagename}_geometry.json instead of the line images")
 
 # limits
 group_limits = parser.add_argument_group('limits')
@@ -74,6 +75,10 @@ group_column.add_argument('--sepwiden',type=int,default=argparse.SUPPRESS, help=
 group_column.add_argument('--maxcolseps',type=int,default=argparse.SUPPRESS, help='maximum # whitespace column separators')
 group_column.add_argument('--csminheight',type=float,default=argparse.SUPPRESS, help='minimum column height (units=scale)')
 
+# multi-resolution parameters
+group_multires = parser.add_argument_group('multi-resolution parameters')
+group_multires.add_argument('--multires', type=str2bool, default=argparse.SUPPRESS, help='find the column separators and gradient maps on a reduced page')
+
 
 args = parser.parse_args()
 
@@ -103,8 +108,12 @@ def call_seg(imagepath, dstDir, parameters):
 	resp = requests.get(url_seg, files=image, data=parameters)
 	print("*** Segmentation service time: %.2f seconds***" % (time.time()-call_begin))
 
+	# Save the JSON of the line geometry responsed from segmentation service
+	if resp.status_code == 200 and parameters.get('output') == 'geometry':
+		with open(os.path.join(dstDir, os.path.splitext(image_name)[0] + "_geometry.json"), 'wb') as f:
+			f.write(resp.content)
 	# Unpress the zip file responsed from segmentation service, and save it
-	if resp.status_code == 200:
+	elif resp.status_code == 200:
 		# For python 3+, replace with io.BytesIO(resp.content)
 		z = zipfile.ZipFile(StringIO.StringIO(resp.content)) 
 		z.extractall(dstDir)
@@ -121,6 +130,8 @@ if __name__ == '__main__':
 	### Only keep the setable parameters
 	del args['image']
 	del args['output']
+	if args.pop('geometry'):
+		args['output'] = 'geometry'
 
 	### Call segmentation service
 	if os.path.isfile(image):